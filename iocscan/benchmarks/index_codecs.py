@@ -0,0 +1,125 @@
+"""
+index_codecs.py : Index codec benchmark
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Writes a synthetic index with each codec and measures the write time, the
+file size, the open time, random lookups and a full read of the records
+(what a compaction or a change report does).
+
+    python benchmarks/index_codecs.py --count 2000000 --codecs none,zlib:1,zlib:6,lzma:6,zstd:3
+"""
+import argparse
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from iocscan.index_codec import DEFAULT_BLOCK_SIZE, available_codecs, get_codec, write_blocks  # noqa: E402
+from iocscan.index_format import MappedIndex, write_index  # noqa: E402
+
+DIRECTORIES = ['/Windows/System32', '/Windows/SysWOW64', '/Program Files/Vendor', '/Users/user/AppData/Local']
+EXTENSIONS = ['.exe', '.dll', '.sys', '.scr']
+
+
+def synthetic_entries(count: int, seed: int = 0) -> list:
+    """Records sorted by key, with random digests and realistic paths"""
+    rng = random.Random(seed)
+    keys = sorted(struct.pack('<QdI', num, 1.5e9 + rng.random() * 1e8, rng.getrandbits(32))
+                  for num in range(count))
+    entries = []
+    for num, key in enumerate(keys):
+        path = '{}/dir{}/file{}{}'.format(DIRECTORIES[num % len(DIRECTORIES)], num % 997, num,
+                                          EXTENSIONS[num % len(EXTENSIONS)])
+        digests = rng.getrandbits(68 * 8).to_bytes(68, 'little')
+        entries.append((key, 'C:', path, '', digests[:16], digests[16:36], digests[36:], rng.random() * 8,
+                        [] if num % 100 else ['ns:rule{}'.format(num % 7)]))
+    return entries
+
+
+def run(entries: list, codec_name: str, level, lookups: list, block_size: int, directory: Path) -> dict:
+    codec = get_codec(codec_name)
+    path = directory / 'iocscan.index.{}'.format(codec_name)
+    start = time.perf_counter()
+    with path.open('w+b') as ofile:
+        if codec is None:
+            write_index(ofile, len(entries), iter(entries), b'R' * 32, None, 1)
+        else:
+            with tempfile.TemporaryFile(dir=str(directory)) as raw:
+                write_index(raw, len(entries), iter(entries), b'R' * 32, None, 1)
+                write_blocks(raw, ofile, codec, level, block_size)
+        ofile.flush()
+        os.fsync(ofile.fileno())
+    write_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = MappedIndex(path)
+    open_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for key in lookups:
+        if index.find(key) < 0:
+            raise AssertionError('Missing key')
+    lookup_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for num in range(len(index)):
+        index.raw_fields(num)
+    read_time = time.perf_counter() - start
+    index.close()
+
+    size = path.stat().st_size
+    os.remove(str(path))
+    return dict(codec=codec_name if codec is None else '{}:{}'.format(codec_name, level or codec.default_level),
+                size=size, write_time=write_time, open_time=open_time,
+                lookup_us=lookup_time / len(lookups) * 1e6, read_time=read_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the index codecs')
+    parser.add_argument('--count', type=int, default=2000000, help='records in the synthetic index')
+    parser.add_argument('--codecs', default=','.join(available_codecs()),
+                        help='comma separated codec[:level] list, available: {}'.format(', '.join(available_codecs())))
+    parser.add_argument('--lookups', type=int, default=100000, help='random lookups per codec')
+    parser.add_argument('--block-kb', type=int, default=DEFAULT_BLOCK_SIZE // 1024, help='compressed block size')
+    parser.add_argument('--dir', default=None, help='where to write the indexes')
+    args = parser.parse_args()
+
+    print('Generating {} records'.format(args.count))
+    entries = synthetic_entries(args.count)
+    rng = random.Random(1)
+    lookups = [entries[rng.randrange(len(entries))][0] for _ in range(min(args.lookups, len(entries)))]
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        print('{:<10} {:>12} {:>10} {:>10} {:>12} {:>10}'.format(
+            'codec', 'size (MB)', 'write (s)', 'open (s)', 'lookup (us)', 'read (s)'))
+        for spec in args.codecs.split(','):
+            name, _, level = spec.partition(':')
+            result = run(entries, name, int(level) if level else None, lookups, args.block_kb * 1024,
+                         Path(directory))
+            print('{codec:<10} {size_mb:>12.1f} {write_time:>10.2f} {open_time:>10.3f} {lookup_us:>12.1f} '
+                  '{read_time:>10.2f}'.format(size_mb=result['size'] / 1024 / 1024, **result))
+
+
+if __name__ == '__main__':
+    main()
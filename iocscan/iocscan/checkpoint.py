@@ -0,0 +1,108 @@
+"""
+checkpoint.py : Resumable scan checkpoints
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+CHECKPOINT_VERSION = 2
+
+
+class UnitProgress(object):
+    """Completion of the items enumerated from one scan unit
+
+    Items are numbered in enumeration order. Every item below watermark is
+    done, done holds the items completed out of order above it.
+    """
+
+    def __init__(self, state: dict = None):
+        state = state or dict()
+        self.watermark = state.get('watermark', 0)
+        self.done = set(state.get('done', []))
+        self.complete = state.get('complete', False)
+        self.enumerated = self.complete
+        self.next_seq = 0
+        self.__lock = threading.Lock()
+
+    def is_done(self, seq: int) -> bool:
+        return seq < self.watermark or seq in self.done
+
+    def mark_done(self, seq: int):
+        with self.__lock:
+            if seq < self.watermark:
+                return
+            self.done.add(seq)
+            while self.watermark in self.done:
+                self.done.remove(self.watermark)
+                self.watermark += 1
+
+    def state(self) -> dict:
+        with self.__lock:
+            return dict(
+                watermark=self.watermark,
+                done=sorted(self.done),
+                complete=self.complete or (self.enumerated and self.watermark >= self.next_seq)
+            )
+
+
+class ScanCheckpoint(object):
+    """Checkpoint files of an interrupted scan"""
+
+    def __init__(self, path: Path = Path('iocscan.checkpoint')):
+        self.path = path
+        self.journal_path = path.with_name(path.name + '.journal')
+
+    def load(self, max_age: float):
+        """Checkpoint state if a recent enough one exists"""
+        if not self.path.exists() or not self.journal_path.exists():
+            return None
+        try:
+            with self.path.open('r', encoding='utf-8') as ifile:
+                state = json.load(ifile)
+        except (OSError, ValueError) as exc:
+            logging.error("Cannot load checkpoint %s: %s", self.path, exc)
+            return None
+        if state.get('version') != CHECKPOINT_VERSION or time.time() - state.get('saved', 0) > max_age:
+            logging.info("Discarding outdated checkpoint %s", self.path)
+            self.clear()
+            return None
+        return state
+
+    def save(self, state: dict, indexer):
+        # Only valid up to the journal size recorded in state, a torn append is dropped on resume
+        state['index'] = indexer.save_checkpoint(self.journal_path)
+
+        state['version'] = CHECKPOINT_VERSION
+        state['saved'] = time.time()
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with tmp_path.open('w', encoding='utf-8') as ofile:
+            json.dump(state, ofile)
+        os.replace(str(tmp_path), str(self.path))
+
+    def restore(self, state: dict, indexer):
+        indexer.restore_checkpoint(state['index'], self.journal_path)
+
+    def clear(self):
+        for path in (self.path, self.journal_path):
+            if path.exists():
+                os.remove(str(path))
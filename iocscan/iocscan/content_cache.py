@@ -0,0 +1,119 @@
+"""
+content_cache.py : Results of already seen file contents
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import binascii
+import hashlib
+import struct
+import threading
+from collections import OrderedDict, namedtuple
+
+FINGERPRINT_BLOCK = 64 * 1024
+
+# Stands for a yara match object, only the fields used by the scanners
+CachedMatch = namedtuple('CachedMatch', ['namespace', 'rule'])
+
+
+def content_fingerprint(size: int, head: bytes, tail: bytes) -> bytes:
+    """Size and hash of the first and last blocks of a stream
+
+    Streams up to two blocks long are hashed whole.
+    """
+    return struct.pack('<Q', size) + hashlib.sha1(head + tail).digest()
+
+
+class FrozenHash(object):
+    """Finished digest with the hashlib accessors"""
+    __slots__ = ('value',)
+
+    def __init__(self, value: bytes):
+        self.value = value
+
+    def digest(self) -> bytes:
+        return self.value
+
+    def hexdigest(self) -> str:
+        return binascii.hexlify(self.value).decode('ascii')
+
+
+class CachedDigest(object):
+    """Digests and entropy of a content seen under another path, same interface as StreamDigest"""
+    __slots__ = ('hashes', 'entropy')
+
+    def __init__(self, hashes: dict, entropy: float):
+        self.hashes = hashes
+        self.entropy = entropy
+
+    @classmethod
+    def from_digest(cls, digest):
+        return cls({name: FrozenHash(hash_obj.digest()) for name, hash_obj in digest.hashes.items()}, digest.entropy)
+
+    def as_dict(self) -> dict:
+        out = dict(self.hashes)
+        out['entropy'] = self.entropy
+        return out
+
+
+class ContentCache(object):
+    """Digests and yara verdicts by content fingerprint, shared by the scan workers
+
+    Two streams with the same size, first and last blocks are assumed to be
+    identical, a stream modified only in the middle would reuse the results
+    of the original one. Least recently used entries are evicted past
+    max_entries.
+    """
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self.__lock = threading.Lock()
+        # fingerprint -> [CachedDigest or None, {ruleset: [CachedMatch]}]
+        self.__entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __entry(self, fingerprint: bytes, create: bool = False):
+        entry = self.__entries.get(fingerprint)
+        if entry is not None:
+            self.__entries.move_to_end(fingerprint)
+        elif create:
+            entry = self.__entries[fingerprint] = [None, dict()]
+            if len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+        return entry
+
+    def get_digest(self, fingerprint: bytes):
+        with self.__lock:
+            entry = self.__entry(fingerprint)
+            return entry[0] if entry is not None else None
+
+    def put_digest(self, fingerprint: bytes, digest):
+        with self.__lock:
+            self.__entry(fingerprint, create=True)[0] = CachedDigest.from_digest(digest)
+
+    def get_matches(self, fingerprint: bytes, ruleset: bytes):
+        """Cached yara matches, None if this content was not scanned with ruleset"""
+        with self.__lock:
+            entry = self.__entry(fingerprint)
+            return entry[1].get(ruleset) if entry is not None else None
+
+    def put_matches(self, fingerprint: bytes, ruleset: bytes, matches: list):
+        with self.__lock:
+            self.__entry(fingerprint, create=True)[1][ruleset] = [
+                CachedMatch(match.namespace, match.rule) for match in matches]
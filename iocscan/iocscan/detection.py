@@ -0,0 +1,64 @@
+"""
+detection.py : Detection records
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from collections import namedtuple
+from typing import Iterable, List
+
+# Immutable per-stream block shared by every detection on that stream
+FileInfo = namedtuple('FileInfo', ['filepath', 'md5', 'sha1', 'sha256', 'entropy', 'deleted'])
+
+
+class Detection(object):
+    """One rule hit on one file stream"""
+    __slots__ = ('info', 'rule')
+
+    def __init__(self, info: FileInfo, rule: str):
+        self.info = info
+        self.rule = rule
+
+    def __repr__(self):
+        return 'Detection({!r}, {!r})'.format(self.info.filepath, self.rule)
+
+
+def serialize_batch(detections: Iterable[Detection], extra=None, timestamp=None) -> List[dict]:
+    """Report entries for a batch of detections
+
+    The common part of the entries is only built once per FileInfo.
+    """
+    out = []
+    base_info, base = None, None
+    for detection in detections:
+        if detection.info is not base_info:
+            base_info = detection.info
+            base = dict(
+                extra=extra,
+                filepath=base_info.filepath,
+                md5=base_info.md5,
+                sha1=base_info.sha1,
+                sha256=base_info.sha256,
+                entropy=base_info.entropy,
+                timestamp=timestamp
+            )
+            if base_info.deleted:
+                base['deleted'] = True
+        entry = dict(base)
+        entry['rule'] = detection.rule
+        out.append(entry)
+    return out
@@ -0,0 +1,262 @@
+"""
+hash_index.py : Digest lookups over the indexed files
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Rebuilt from the index after every scan, other apps can open it to look
+up digests without scanning.
+
+Layout (little endian):
+    header   magic, version, bloom hash count, record count, bloom size,
+             md5, sha1 and sha256 table sizes, heap size
+    records  heap offset of the path, md5, sha1, sha256
+    tables   one per algorithm: digest and record number, sorted by digest
+    bloom    bit array over every digest of every table
+    heap     null terminated UTF-8 paths
+"""
+import binascii
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from pathlib import Path
+
+from .index_diff import display_path
+from .index_format import IndexFormatError, commit_file
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_PATH = Path('iocscan.hashes')
+MAGIC = b'SONEHASH'
+# 2: paths without the mountpoint prepended
+VERSION = 2
+HEADER = struct.Struct('<8sBBxxIIIIII')
+RECORD = struct.Struct('<I16s20s32s')
+ALGORITHMS = (('md5', 16), ('sha1', 20), ('sha256', 32))
+# Digests are uniformly distributed, the bloom positions are taken from their first bytes
+BLOOM_HASHES = 4
+BLOOM_BITS_PER_DIGEST = 10
+
+
+def _unknown(size: int) -> bytes:
+    # Digest stored for a stream that was not hashed
+    return b'0' * size
+
+
+def bloom_positions(digest: bytes, bits: int) -> list:
+    return [pos % bits for pos in struct.unpack_from('<{}I'.format(BLOOM_HASHES), digest)]
+
+
+def build_bloom(columns: list, size: int) -> bytearray:
+    """Bloom filter of size bytes over the known digests of each (column, digest size)"""
+    bits = size * 8
+    if numpy is not None:
+        flags = numpy.zeros(bits, dtype=bool)
+        for column, digest_size in columns:
+            digests = numpy.frombuffer(bytes(column), dtype='V{}'.format(digest_size))
+            known = digests[digests != numpy.frombuffer(_unknown(digest_size), dtype='V{}'.format(digest_size))[0]]
+            words = numpy.frombuffer(known.tobytes(), dtype='<u4').reshape(-1, digest_size // 4)
+            flags[(words[:, :BLOOM_HASHES].astype(numpy.uint64) % bits).ravel()] = True
+        return bytearray(numpy.packbits(flags, bitorder='little').tobytes())
+    bloom = bytearray(size)
+    for column, digest_size in columns:
+        unknown = _unknown(digest_size)
+        for offset in range(0, len(column), digest_size):
+            digest = bytes(column[offset:offset + digest_size])
+            if digest != unknown:
+                for pos in bloom_positions(digest, bits):
+                    bloom[pos >> 3] |= 1 << (pos & 7)
+    return bloom
+
+
+def sorted_digests(column: bytearray, digest_size: int) -> bytes:
+    """Table of (digest, record number) of the known digests, by digest"""
+    count = len(column) // digest_size
+    entry = struct.Struct('<{}sI'.format(digest_size))
+    unknown = _unknown(digest_size)
+    if numpy is not None:
+        digests = numpy.frombuffer(bytes(column), dtype='V{}'.format(digest_size))
+        order = numpy.argsort(digests, kind='stable')
+        order = order[digests[order] != numpy.frombuffer(unknown, dtype='V{}'.format(digest_size))[0]]
+        table = numpy.empty(len(order), dtype=[('digest', 'V{}'.format(digest_size)), ('num', '<u4')])
+        table['digest'] = digests[order]
+        table['num'] = order
+        return table.tobytes()
+    order = sorted((num for num in range(count)
+                    if column[num * digest_size:(num + 1) * digest_size] != unknown),
+                   key=lambda num: column[num * digest_size:(num + 1) * digest_size])
+    return b''.join(entry.pack(bytes(column[num * digest_size:(num + 1) * digest_size]), num) for num in order)
+
+
+def write_hash_index(ofile, records):
+    """Write the hash index of records, (mountpoint, path, ads, md5, sha1, sha256, entropy) tuples"""
+    columns = [bytearray() for _ in ALGORITHMS]
+    count = 0
+    with tempfile.TemporaryFile() as heap:
+        heap_size = 0
+        ofile.write(b'\0' * HEADER.size)
+        batch = bytearray()
+        for _, path, ads, md5, sha1, sha256, _ in records:
+            batch += RECORD.pack(heap_size, md5, sha1, sha256)
+            for column, digest in zip(columns, (md5, sha1, sha256)):
+                column += digest
+            value = display_path(path, ads).encode('utf-8') + b'\0'
+            heap.write(value)
+            heap_size += len(value)
+            count += 1
+            if len(batch) >= 1024 * 1024:
+                ofile.write(batch)
+                batch = bytearray()
+        ofile.write(batch)
+
+        table_sizes = []
+        for column, (_, digest_size) in zip(columns, ALGORITHMS):
+            table = sorted_digests(column, digest_size)
+            table_sizes.append(len(table) // (digest_size + 4))
+            ofile.write(table)
+        bloom_size = max(8, (sum(table_sizes) * BLOOM_BITS_PER_DIGEST + 7) // 8)
+        ofile.write(build_bloom([(column, digest_size) for column, (_, digest_size) in zip(columns, ALGORITHMS)],
+                                bloom_size))
+
+        heap.seek(0)
+        shutil.copyfileobj(heap, ofile)
+
+    ofile.seek(0)
+    ofile.write(HEADER.pack(MAGIC, VERSION, BLOOM_HASHES, count, bloom_size, *(table_sizes + [heap_size])))
+
+
+class HashIndex(object):
+    """Read-only view of a hash index, lookups go through the bloom filter first"""
+
+    def __init__(self, path: Path = DEFAULT_PATH):
+        with path.open('rb') as ifile:
+            self.__mm = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.__validate()
+        except (struct.error, IndexFormatError):
+            self.__mm.close()
+            raise
+
+    def __validate(self):
+        magic, version, self.bloom_hashes, self.count, bloom_size, md5_count, sha1_count, sha256_count, heap_size = \
+            HEADER.unpack_from(self.__mm, 0)
+        if magic != MAGIC or version != VERSION or self.bloom_hashes != BLOOM_HASHES:
+            raise IndexFormatError('Not a SONEHASH v{} file'.format(VERSION))
+        offset = HEADER.size + self.count * RECORD.size
+        # name -> (table offset, entry count, digest size)
+        self.tables = dict()
+        for (name, digest_size), count in zip(ALGORITHMS, (md5_count, sha1_count, sha256_count)):
+            self.tables[name] = (offset, count, digest_size)
+            offset += count * (digest_size + 4)
+        self.bloom_offset = offset
+        self.bloom_bits = bloom_size * 8
+        self.heap_offset = offset + bloom_size
+        if self.heap_offset + heap_size != len(self.__mm):
+            raise IndexFormatError('Truncated hash index')
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.__mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def may_contain(self, digest: bytes) -> bool:
+        """False if no indexed file has this digest, True if one probably does"""
+        mm = self.__mm
+        for pos in bloom_positions(digest, self.bloom_bits):
+            if not mm[self.bloom_offset + (pos >> 3)] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def find(self, name: str, digest: bytes) -> list:
+        """Numbers of the records with this digest"""
+        offset, count, digest_size = self.tables[name]
+        if len(digest) != digest_size or not self.may_contain(digest):
+            return []
+        mm = self.__mm
+        stride = digest_size + 4
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            pos = offset + mid * stride
+            if mm[pos:pos + digest_size] < digest:
+                low = mid + 1
+            else:
+                high = mid
+        nums = []
+        while low < count:
+            pos = offset + low * stride
+            if mm[pos:pos + digest_size] != digest:
+                break
+            nums.append(struct.unpack_from('<I', mm, pos + digest_size)[0])
+            low += 1
+        return nums
+
+    def record(self, num: int) -> tuple:
+        """(path, md5, sha1, sha256) of a record"""
+        path_offset, md5, sha1, sha256 = RECORD.unpack_from(self.__mm, HEADER.size + num * RECORD.size)
+        start = self.heap_offset + path_offset
+        return self.__mm[start:self.__mm.find(b'\0', start)].decode('utf-8'), md5, sha1, sha256
+
+    def lookup(self, hexdigest: str) -> list:
+        """Records of a hex md5, sha1 or sha256"""
+        digest = binascii.unhexlify(hexdigest.strip())
+        for name, digest_size in ALGORITHMS:
+            if len(digest) == digest_size:
+                return [self.record(num) for num in self.find(name, digest)]
+        raise ValueError('Not a md5, sha1 or sha256: {}'.format(hexdigest))
+
+    def match(self, hexdigests) -> list:
+        """(hex digest, record) of every record matching one of hexdigests"""
+        out = []
+        for hexdigest in sorted(set(value.strip().lower() for value in hexdigests if value.strip())):
+            try:
+                records = self.lookup(hexdigest)
+            except (ValueError, binascii.Error):
+                continue
+            out += [(hexdigest, record) for record in records]
+        return out
+
+
+def is_valid(path: Path = DEFAULT_PATH) -> bool:
+    """True if path holds a readable hash index of the current version"""
+    try:
+        with HashIndex(path):
+            return True
+    except (OSError, ValueError, struct.error, IndexFormatError):
+        return False
+
+
+def save_hash_index(records, path: Path = DEFAULT_PATH):
+    """Replace the hash index at path atomically"""
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open('w+b') as ofile:
+        write_hash_index(ofile, records)
+        ofile.flush()
+        os.fsync(ofile.fileno())
+    commit_file(tmp_path, path)
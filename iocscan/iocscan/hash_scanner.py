@@ -0,0 +1,101 @@
+"""
+hash_scanner.py : Hash IOC scanner
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import binascii
+import logging
+import time
+from pathlib import Path
+from typing import Tuple
+
+from epc.common.data import DataClient
+from epc.common.data.client import DataException
+from epc.common.exceptions import DataError
+from .detection import Detection, FileInfo, serialize_batch
+from .hash_index import DEFAULT_PATH, HashIndex
+from .index_format import IndexFormatError
+from .indexer import Indexer
+from .metrics import ScanMetrics
+from .path_filter import PathFilter
+from .stream_pass import StreamPass
+
+
+def _hex(digest: bytes):
+    if digest == b'0' * len(digest):
+        return None
+    return binascii.hexlify(digest).decode('ascii')
+
+
+class HashScanner(object):
+    """Match md5, sha1 and sha256 IOCs against the hash index
+
+    Nothing is read during the scan, the IOCs are looked up once the hash
+    index was rebuilt from the digests of this run.
+    """
+
+    def __init__(self, config, indexer: Indexer, path_filter: PathFilter, metrics: ScanMetrics = None,
+                 hash_path: Path = DEFAULT_PATH):
+        self.config = config
+        self.iocs = []
+        self.hash_path = hash_path
+        self.__metrics = metrics or ScanMetrics()
+
+    def init(self):
+        self.iocs = list(self.config.get('HASH_IOCS') or [])
+        blob = self.config.get('HASH_IOCS_FILE')
+        if blob:
+            try:
+                data = DataClient().get('http_blob', blob)
+            except (DataException, DataError):
+                data = None
+            if not data:
+                logging.error("Cannot get hash IOCs %s", blob)
+                return 1
+            self.iocs += data.decode('utf-8', 'replace').splitlines()
+        logging.info("%d hash IOCs loaded", len(self.iocs))
+
+    def process(self, mountpoint, fobj, stream_pass: StreamPass = None):
+        return None
+
+    def save_checkpoint(self) -> dict:
+        return dict()
+
+    def restore_checkpoint(self, state: dict):
+        pass
+
+    def finalize(self) -> Tuple[dict, list]:
+        start = time.perf_counter()
+        try:
+            with HashIndex(self.hash_path) as hash_index:
+                matches = hash_index.match(self.iocs)
+        except (OSError, IndexFormatError) as exc:
+            logging.error("Cannot open hash index %s: %s", self.hash_path, exc)
+            return dict(hash_ioc_count=len(self.iocs), hash_ioc_error=str(exc)), []
+        elapsed = time.perf_counter() - start
+        self.__metrics.observe('hash_ioc_time', elapsed)
+
+        detections = []
+        for hexdigest, (path, md5, sha1, sha256) in matches:
+            info = FileInfo(filepath=path, md5=_hex(md5), sha1=_hex(sha1), sha256=_hex(sha256),
+                            entropy=None, deleted=False)
+            detections.append(Detection(info, 'hash_ioc:{}'.format(hexdigest)))
+        logging.info("%d hash IOCs matched %d files in %s", len(self.iocs), len(detections), elapsed)
+        report = serialize_batch(detections, extra=self.config.get("task_id", None),
+                                 timestamp=self.config.get('timestamp'))
+        return dict(hash_ioc_count=len(self.iocs), hash_ioc_detect_count=len(detections)), report
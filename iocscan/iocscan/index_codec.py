@@ -0,0 +1,245 @@
+"""
+index_codec.py : Block compression of index files
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+A compressed index is the plain index cut in fixed-size blocks compressed
+independently, so a lookup only inflates the blocks it reads.
+
+Layout (little endian):
+    header   magic, version, codec, level, block size, uncompressed size,
+             block count
+    offsets  block count + 1 u64, file offset of each block and of the end
+    blocks   compressed blocks
+    trailer  magic, block count and CRC32 of everything before it
+"""
+import lzma
+import mmap
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BLOCK_MAGIC = b'SONEBLKZ'
+BLOCK_VERSION = 1
+BLOCK_HEADER = struct.Struct('<8sBBBxIQI')
+TRAILER = struct.Struct('<8sII')
+TRAILER_MAGIC = b'SONETAIL'
+DEFAULT_BLOCK_SIZE = 64 * 1024
+DEFAULT_CACHE_BLOCKS = 1024
+
+
+class CodecError(Exception):
+    pass
+
+
+class Codec(object):
+    """Compression of independent blocks"""
+    name = None
+    ident = None
+    default_level = None
+
+    def compress(self, data: bytes, level: int) -> bytes:
+        raise NotImplementedError()
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError()
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+    ident = 1
+    default_level = 6
+
+    def compress(self, data: bytes, level: int) -> bytes:
+        return zlib.compress(data, level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class LzmaCodec(Codec):
+    name = 'lzma'
+    ident = 2
+    default_level = 6
+
+    def compress(self, data: bytes, level: int) -> bytes:
+        return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_NONE, preset=level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lzma.decompress(data, format=lzma.FORMAT_XZ)
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    ident = 3
+    default_level = 3
+
+    def compress(self, data: bytes, level: int) -> bytes:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+CODECS = [ZlibCodec(), LzmaCodec()]
+if zstandard is not None:
+    CODECS.append(ZstdCodec())
+
+
+def available_codecs() -> list:
+    return ['none'] + [codec.name for codec in CODECS]
+
+
+def get_codec(name: str):
+    """Codec by name, None for uncompressed indexes"""
+    if not name or name == 'none':
+        return None
+    for codec in CODECS:
+        if codec.name == name:
+            return codec
+    raise CodecError('Unsupported index codec {}'.format(name))
+
+
+def _codec_by_ident(ident: int) -> Codec:
+    for codec in CODECS:
+        if codec.ident == ident:
+            return codec
+    raise CodecError('Index compressed with an unsupported codec ({})'.format(ident))
+
+
+def write_blocks(ifile, ofile, codec: Codec, level: int = None, block_size: int = DEFAULT_BLOCK_SIZE):
+    """Compress the whole content of ifile to ofile"""
+    level = codec.default_level if level is None else level
+    ifile.seek(0, 2)
+    raw_size = ifile.tell()
+    count = (raw_size + block_size - 1) // block_size
+    offsets = [BLOCK_HEADER.size + 8 * (count + 1)]
+    ifile.seek(0)
+    ofile.write(BLOCK_HEADER.pack(BLOCK_MAGIC, BLOCK_VERSION, codec.ident, level, block_size, raw_size, count))
+    ofile.write(b'\0' * 8 * (count + 1))
+    for _ in range(count):
+        block = codec.compress(ifile.read(block_size), level)
+        ofile.write(block)
+        offsets.append(offsets[-1] + len(block))
+    ofile.seek(BLOCK_HEADER.size)
+    ofile.write(struct.pack('<{}Q'.format(count + 1), *offsets))
+
+    ofile.seek(0)
+    crc = 0
+    while True:
+        chunk = ofile.read(1024 * 1024)
+        if not chunk:
+            break
+        crc = zlib.crc32(chunk, crc)
+    ofile.write(TRAILER.pack(TRAILER_MAGIC, count, crc))
+
+
+class BlockFile(object):
+    """Read-only, sliceable view of the uncompressed content of a compressed file
+
+    Blocks are inflated on first access, at most cache_blocks of them are
+    kept.
+    """
+
+    def __init__(self, fileobj, verify: bool = True, cache_blocks: int = DEFAULT_CACHE_BLOCKS):
+        self.__mm = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__lock = threading.Lock()
+        self.__cache = OrderedDict()
+        self.__cache_blocks = max(1, cache_blocks)
+        try:
+            self.__validate(verify)
+        except (struct.error, CodecError):
+            self.__mm.close()
+            raise
+
+    def __validate(self, verify: bool):
+        mm = self.__mm
+        magic, version, ident, self.level, self.block_size, self.size, count = \
+            BLOCK_HEADER.unpack(mm[:BLOCK_HEADER.size])
+        if magic != BLOCK_MAGIC or version != BLOCK_VERSION:
+            raise CodecError('Not a compressed index')
+        self.codec = _codec_by_ident(ident)
+        end = len(mm) - TRAILER.size
+        trailer_magic, trailer_count, crc = TRAILER.unpack(mm[end:])
+        if trailer_magic != TRAILER_MAGIC or trailer_count != count:
+            raise CodecError('Incomplete compressed index')
+        self.offsets = struct.unpack('<{}Q'.format(count + 1),
+                                     mm[BLOCK_HEADER.size:BLOCK_HEADER.size + 8 * (count + 1)])
+        if self.offsets[-1] != end or count * self.block_size < self.size:
+            raise CodecError('Truncated compressed index')
+        if verify:
+            value = 0
+            for offset in range(0, end, 1024 * 1024):
+                value = zlib.crc32(mm[offset:min(end, offset + 1024 * 1024)], value)
+            if value != crc:
+                raise CodecError('Checksum mismatch')
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        self.__cache.clear()
+        self.__mm.close()
+
+    def __block(self, num: int) -> bytes:
+        with self.__lock:
+            block = self.__cache.get(num)
+            if block is not None:
+                self.__cache.move_to_end(num)
+                return block
+        try:
+            block = self.codec.decompress(self.__mm[self.offsets[num]:self.offsets[num + 1]])
+        except Exception as exc:
+            raise CodecError('Corrupt block {}: {}'.format(num, exc)) from exc
+        with self.__lock:
+            self.__cache[num] = block
+            if len(self.__cache) > self.__cache_blocks:
+                self.__cache.popitem(last=False)
+        return block
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            if item < 0:
+                item += self.size
+            return self.__block(item // self.block_size)[item % self.block_size]
+        start, stop, _ = item.indices(self.size)
+        if start >= stop:
+            return b''
+        first, last = start // self.block_size, (stop - 1) // self.block_size
+        if first == last:
+            offset = first * self.block_size
+            return self.__block(first)[start - offset:stop - offset]
+        parts = [self.__block(num) for num in range(first, last + 1)]
+        parts[0] = parts[0][start - first * self.block_size:]
+        parts[-1] = parts[-1][:stop - last * self.block_size]
+        return b''.join(parts)
+
+    def find(self, sub: bytes, start: int = 0) -> int:
+        """Like bytes.find, sub must be a single byte"""
+        for num in range(start // self.block_size, (self.size + self.block_size - 1) // self.block_size):
+            offset = num * self.block_size
+            pos = self.__block(num).find(sub, max(0, start - offset))
+            if pos >= 0:
+                return offset + pos
+        return -1
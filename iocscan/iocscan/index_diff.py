@@ -0,0 +1,183 @@
+"""
+index_diff.py : Changes between two index generations
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import binascii
+import hashlib
+from pathlib import Path
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ID_SIZE = 20
+SHA256_SIZE = 32
+
+
+def _encode(value) -> bytes:
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+def path_id(mountpoint, path, ads) -> bytes:
+    """Identity of a stream across index generations, keys also depend on inode and mtime"""
+    return hashlib.sha1(b'\0'.join([_encode(mountpoint), _encode(path), _encode(ads)])).digest()
+
+
+def display_path(path, ads) -> str:
+    """Stream path as reported in the detections, the stored path already includes the drive"""
+    return str(Path(_encode(path).decode('utf-8', 'replace'))) + _encode(ads).decode('utf-8', 'replace')
+
+
+def hex_digest(digest: bytes):
+    """Hex sha256, None for a stream that was not hashed"""
+    if digest == b'0' * SHA256_SIZE:
+        return None
+    return binascii.hexlify(digest).decode('ascii')
+
+
+def unset_bits(bitmap: bytearray, count: int) -> list:
+    """Positions of the zero bits among the first count bits of a little endian bitmap"""
+    if numpy is not None:
+        bits = numpy.unpackbits(numpy.frombuffer(bytes(bitmap), dtype=numpy.uint8), bitorder='little')[:count]
+        return numpy.flatnonzero(bits == 0).tolist()
+    out = []
+    for pos, byte in enumerate(bitmap):
+        if byte == 0xFF:
+            continue
+        for bit in range(8):
+            num = pos * 8 + bit
+            if num < count and not byte & (1 << bit):
+                out.append(num)
+    return out
+
+
+def match_ids(old_ids: bytes, new_ids: bytes):
+    """Join two packed arrays of ids
+
+    Returns (old positions, new positions) of the common ids followed by
+    the positions only found in old_ids and only found in new_ids.
+    """
+    old_count = len(old_ids) // ID_SIZE
+    new_count = len(new_ids) // ID_SIZE
+    if numpy is not None:
+        old = numpy.frombuffer(old_ids, dtype='V{}'.format(ID_SIZE))
+        new = numpy.frombuffer(new_ids, dtype='V{}'.format(ID_SIZE))
+        _, old_common, new_common = numpy.intersect1d(old, new, return_indices=True)
+        old_only = numpy.ones(old_count, dtype=bool)
+        old_only[old_common] = False
+        new_only = numpy.ones(new_count, dtype=bool)
+        new_only[new_common] = False
+        return (old_common.tolist(), new_common.tolist(),
+                numpy.flatnonzero(old_only).tolist(), numpy.flatnonzero(new_only).tolist())
+
+    def sorted_positions(ids: bytes, count: int) -> list:
+        return sorted(range(count), key=lambda pos: ids[pos * ID_SIZE:(pos + 1) * ID_SIZE])
+
+    old_sorted = sorted_positions(old_ids, old_count)
+    new_sorted = sorted_positions(new_ids, new_count)
+    old_common, new_common, old_only, new_only = [], [], [], []
+    old_pos = new_pos = 0
+    while old_pos < old_count and new_pos < new_count:
+        old_num, new_num = old_sorted[old_pos], new_sorted[new_pos]
+        old_id = old_ids[old_num * ID_SIZE:(old_num + 1) * ID_SIZE]
+        new_id = new_ids[new_num * ID_SIZE:(new_num + 1) * ID_SIZE]
+        if old_id < new_id:
+            old_only.append(old_num)
+            old_pos += 1
+        elif old_id > new_id:
+            new_only.append(new_num)
+            new_pos += 1
+        else:
+            old_common.append(old_num)
+            new_common.append(new_num)
+            old_pos += 1
+            new_pos += 1
+    old_only += old_sorted[old_pos:]
+    new_only += new_sorted[new_pos:]
+    return old_common, new_common, sorted(old_only), sorted(new_only)
+
+
+def differing(old_digests: bytes, old_pos: list, new_digests: bytes, new_pos: list) -> list:
+    """For each pair, True if both sha256 are known and differ"""
+    unknown = b'0' * SHA256_SIZE
+    if numpy is not None and old_pos:
+        old = numpy.frombuffer(old_digests, dtype='V{}'.format(SHA256_SIZE))[old_pos]
+        new = numpy.frombuffer(new_digests, dtype='V{}'.format(SHA256_SIZE))[new_pos]
+        missing = numpy.frombuffer(unknown, dtype='V{}'.format(SHA256_SIZE))[0]
+        return ((old != new) & (old != missing) & (new != missing)).tolist()
+    out = []
+    for old_num, new_num in zip(old_pos, new_pos):
+        old = old_digests[old_num * SHA256_SIZE:(old_num + 1) * SHA256_SIZE]
+        new = new_digests[new_num * SHA256_SIZE:(new_num + 1) * SHA256_SIZE]
+        out.append(old != new and old != unknown and new != unknown)
+    return out
+
+
+class IndexDiff(object):
+    """Streams added, removed and modified since the previous index
+
+    modified holds (path, old sha256, new sha256, hash changed) for streams
+    indexed under a new key, hash changed is False for a touched file.
+    """
+
+    def __init__(self, added: list, removed: list, modified: list):
+        self.added = added
+        self.removed = removed
+        self.modified = modified
+
+    @classmethod
+    def from_records(cls, old_records: list, new_records: list):
+        """Diff the records that left the index against the records that entered it
+
+        Records are (mountpoint, path, ads, md5, sha1, sha256, entropy).
+        """
+        old_ids = b''.join(path_id(*record[:3]) for record in old_records)
+        new_ids = b''.join(path_id(*record[:3]) for record in new_records)
+        old_common, new_common, old_only, new_only = match_ids(old_ids, new_ids)
+        old_digests = b''.join(record[5] for record in old_records)
+        new_digests = b''.join(record[5] for record in new_records)
+        changed = differing(old_digests, old_common, new_digests, new_common)
+        modified = []
+        for old_num, new_num, hash_changed in zip(old_common, new_common, changed):
+            modified.append((display_path(*new_records[new_num][1:3]),
+                             hex_digest(old_records[old_num][5]),
+                             hex_digest(new_records[new_num][5]),
+                             hash_changed))
+        return cls([display_path(*new_records[num][1:3]) for num in new_only],
+                   [display_path(*old_records[num][1:3]) for num in old_only],
+                   modified)
+
+    def summary(self) -> dict:
+        return dict(
+            added=len(self.added),
+            removed=len(self.removed),
+            modified=len(self.modified),
+            hash_changed=sum(1 for item in self.modified if item[3])
+        )
+
+    def as_report(self, limit: int) -> dict:
+        """Counts and at most limit entries of each set"""
+        report = self.summary()
+        report['truncated'] = max(len(self.added), len(self.removed), len(self.modified)) > limit
+        report['added_files'] = self.added[:limit]
+        report['removed_files'] = self.removed[:limit]
+        report['modified_files'] = [dict(path=path, old_sha256=old, new_sha256=new, hash_changed=hash_changed)
+                                    for path, old, new, hash_changed in self.modified[:limit]]
+        return report
@@ -0,0 +1,324 @@
+"""
+index_format.py : Memory-mapped SONEINDX v2 file index
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Layout (little endian):
+    header   magic, version, flags, bucket bits, key version, count, heap
+             offset and size, ruleset fingerprint
+    buckets  (1 << bits) + 1 u32: first record of each key prefix
+    records  fixed-size, sorted by key
+    heap     null terminated UTF-8 strings referenced by offset
+    removed  optional, delta segments only: magic, count and sorted keys
+             removed from the previous segments
+    base     optional, delta segments only: magic and generation of the
+             base index the delta was written on
+    trailer  magic, record count and CRC32 of everything before it
+
+The whole file may be block compressed, see index_codec.
+"""
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from pathlib import Path
+
+from .index_codec import BLOCK_MAGIC, BlockFile, CodecError
+
+MAGIC = b'SONEINDX'
+VERSION = 2
+HEADER = struct.Struct('<8sBBBBIQQ32s')
+# key, mountpoint, path, ads and verdict offsets, md5, sha1, sha256, entropy
+RECORD = struct.Struct('<20sIIII16s20s32sf')
+BUCKET = struct.Struct('<II')
+KEY_SIZE = 20
+NO_VERDICT = 0xFFFFFFFF
+FLAG_RULESET = 0x01
+REMOVED_MAGIC = b'SONETOMB'
+COUNT = struct.Struct('<I')
+TRAILER = struct.Struct('<8sII')
+TRAILER_MAGIC = b'SONETAIL'
+BASE_MAGIC = b'SONEBASE'
+# record count and CRC32 of an index, from its trailer
+GENERATION = struct.Struct('<II')
+CRC_CHUNK = 1024 * 1024
+MAX_BUCKET_BITS = 16
+WRITE_BATCH = 4096
+
+
+def bucket_bits(count: int) -> int:
+    """About 16 records per bucket"""
+    return max(0, min(MAX_BUCKET_BITS, count.bit_length() - 4))
+
+
+def key_bucket(key: bytes, bits: int) -> int:
+    return ((key[0] << 8) | key[1]) >> (16 - bits) if bits else 0
+
+
+class IndexFormatError(Exception):
+    pass
+
+
+def _unpack(fmt: struct.Struct, data, offset: int) -> tuple:
+    # Slices rather than unpack_from, a BlockFile has no buffer interface
+    return fmt.unpack(data[offset:offset + fmt.size])
+
+
+def file_crc(data, end: int, crc: int = 0) -> int:
+    """CRC32 of the first end bytes of a buffer, without copying it whole"""
+    for offset in range(0, end, CRC_CHUNK):
+        crc = zlib.crc32(data[offset:min(end, offset + CRC_CHUNK)], crc)
+    return crc
+
+
+def commit_file(tmp_path: Path, path: Path):
+    """Atomically replace path by tmp_path, which must already be synced"""
+    os.replace(str(tmp_path), str(path))
+    if hasattr(os, 'O_DIRECTORY'):
+        # Persist the rename itself, not supported on Windows
+        fd = os.open(str(path.parent), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class MappedIndex(object):
+    """Read-only view of a v2 index, nothing is loaded until looked up
+
+    The layout and the trailer are always checked, verify also checks the
+    CRC of the whole file. A block compressed index is read through a
+    BlockFile, only the blocks looked up are inflated.
+    """
+
+    def __init__(self, path: Path, verify: bool = True):
+        with path.open('rb') as ifile:
+            self.compressed = ifile.read(len(BLOCK_MAGIC)) == BLOCK_MAGIC
+            try:
+                if self.compressed:
+                    self.__mm = BlockFile(ifile, verify)
+                else:
+                    self.__mm = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+            except CodecError as exc:
+                raise IndexFormatError(str(exc)) from exc
+        try:
+            self.__validate(verify and not self.compressed)
+        except (struct.error, IndexFormatError):
+            self.__mm.close()
+            raise
+
+    def __validate(self, verify: bool):
+        mm = self.__mm
+        magic, version, flags, self.bits, self.key_version, self.count, self.heap_offset, heap_size, ruleset = \
+            _unpack(HEADER, mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise IndexFormatError('Not a SONEINDX v{} file'.format(VERSION))
+        end = len(mm) - TRAILER.size
+        trailer_magic, count, crc = _unpack(TRAILER, mm, end)
+        if trailer_magic != TRAILER_MAGIC or count != self.count:
+            raise IndexFormatError('Incomplete index')
+        self.ruleset = ruleset if flags & FLAG_RULESET else None
+        self.generation = GENERATION.pack(count, crc)
+        self.records_offset = HEADER.size + 4 * ((1 << self.bits) + 1)
+        if self.records_offset + self.count * RECORD.size != self.heap_offset or \
+                self.heap_offset + heap_size > end:
+            raise IndexFormatError('Truncated index')
+        removed_offset = self.heap_offset + heap_size
+        self.removed_count = 0
+        if mm[removed_offset:removed_offset + len(REMOVED_MAGIC)] == REMOVED_MAGIC:
+            self.removed_count, = _unpack(COUNT, mm, removed_offset + len(REMOVED_MAGIC))
+            self.removed_offset = removed_offset + len(REMOVED_MAGIC) + COUNT.size
+            if self.removed_offset + self.removed_count * KEY_SIZE > end:
+                raise IndexFormatError('Truncated index')
+            removed_offset = self.removed_offset + self.removed_count * KEY_SIZE
+        # None for a base, or a delta written before the base section existed
+        self.base_generation = None
+        if mm[removed_offset:removed_offset + len(BASE_MAGIC)] == BASE_MAGIC:
+            offset = removed_offset + len(BASE_MAGIC)
+            if offset + GENERATION.size > end:
+                raise IndexFormatError('Truncated index')
+            self.base_generation = mm[offset:offset + GENERATION.size]
+        if verify and file_crc(mm, end) != crc:
+            raise IndexFormatError('Checksum mismatch')
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key: bytes):
+        return self.find(key) >= 0
+
+    def close(self):
+        self.__mm.close()
+
+    def find(self, key: bytes) -> int:
+        """Record number of key, -1 if missing"""
+        mm = self.__mm
+        low, high = _unpack(BUCKET, mm, HEADER.size + 4 * key_bucket(key, self.bits))
+        base = self.records_offset
+        size = RECORD.size
+        while low < high:
+            mid = (low + high) // 2
+            offset = base + mid * size
+            other = mm[offset:offset + KEY_SIZE]
+            if other < key:
+                low = mid + 1
+            elif other > key:
+                high = mid
+            else:
+                return mid
+        return -1
+
+    def is_removed(self, key: bytes) -> bool:
+        """True if a delta segment removes key from the previous segments"""
+        mm = self.__mm
+        low, high = 0, self.removed_count
+        while low < high:
+            mid = (low + high) // 2
+            offset = self.removed_offset + mid * KEY_SIZE
+            other = mm[offset:offset + KEY_SIZE]
+            if other < key:
+                low = mid + 1
+            elif other > key:
+                high = mid
+            else:
+                return True
+        return False
+
+    def key(self, num: int) -> bytes:
+        offset = self.records_offset + num * RECORD.size
+        return self.__mm[offset:offset + KEY_SIZE]
+
+    def keys(self):
+        for num in range(self.count):
+            yield self.key(num)
+
+    def string(self, offset: int) -> bytes:
+        """Raw UTF-8 string from the heap"""
+        start = self.heap_offset + offset
+        return self.__mm[start:self.__mm.find(b'\0', start)]
+
+    def raw_fields(self, num: int) -> tuple:
+        """(mountpoint, path, ads, md5, sha1, sha256, entropy), strings undecoded"""
+        _, mountpoint, path, ads, _, md5, sha1, sha256, entropy = _unpack(
+            RECORD, self.__mm, self.records_offset + num * RECORD.size)
+        return self.string(mountpoint), self.string(path), self.string(ads), md5, sha1, sha256, entropy
+
+    def fields(self, key: bytes):
+        num = self.find(key)
+        return self.raw_fields(num) if num >= 0 else None
+
+    def verdict_at(self, num: int):
+        """Stored yara verdict (list of rules) of a record, or None"""
+        offset, = _unpack(COUNT, self.__mm, self.records_offset + num * RECORD.size + KEY_SIZE + 12)
+        if offset == NO_VERDICT:
+            return None
+        rules = self.string(offset).decode('utf-8')
+        return rules.split('\n') if rules else []
+
+    def verdict(self, key: bytes):
+        num = self.find(key)
+        return self.verdict_at(num) if num >= 0 else None
+
+    def record(self, key: bytes):
+        """Decoded record as a dict, like the v1 parser produced"""
+        fields = self.fields(key)
+        if fields is None:
+            return None
+        mountpoint, path, ads, md5, sha1, sha256, entropy = fields
+        return dict(key=key, mountpoint=mountpoint.decode('utf-8'), path=path.decode('utf-8'),
+                    ads=ads.decode('utf-8'), md5=md5, sha1=sha1, sha256=sha256, entropy=entropy)
+
+
+def _encode(value) -> bytes:
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+def write_index(ofile, count: int, entries, ruleset: bytes = None, removed: list = None, key_version: int = 0,
+                base_generation: bytes = None):
+    """Write a v2 index
+
+    entries yields count (key, mountpoint, path, ads, md5, sha1, sha256,
+    entropy, verdict) tuples by increasing key, strings are str or UTF-8
+    bytes and verdict is None or a list of rules. removed, the sorted keys
+    removed from the previous segments, makes it a delta segment, written on
+    the base index of generation base_generation. key_version tells how the
+    keys were derived.
+    """
+    bits = bucket_bits(count)
+    buckets = [0] * ((1 << bits) + 1)
+    records_offset = HEADER.size + 4 * len(buckets)
+    heap_offset = records_offset + count * RECORD.size
+
+    with tempfile.TemporaryFile() as heap:
+        heap_size = 0
+        interned = dict()
+
+        def add_string(value, intern: bool = False) -> int:
+            nonlocal heap_size
+            value = _encode(value)
+            if intern and value in interned:
+                return interned[value]
+            offset = heap_size
+            heap.write(value + b'\0')
+            heap_size += len(value) + 1
+            if intern:
+                interned[value] = offset
+            return offset
+
+        ofile.write(b'\0' * records_offset)
+        batch = bytearray()
+        written = 0
+        for key, mountpoint, path, ads, md5, sha1, sha256, entropy, verdict in entries:
+            buckets[key_bucket(key, bits) + 1] += 1
+            verdict_offset = NO_VERDICT if verdict is None else add_string('\n'.join(verdict), intern=True)
+            batch += RECORD.pack(key, add_string(mountpoint, intern=True), add_string(path),
+                                 add_string(ads, intern=True), verdict_offset, md5, sha1, sha256, entropy)
+            written += 1
+            if written % WRITE_BATCH == 0:
+                ofile.write(batch)
+                batch = bytearray()
+        ofile.write(batch)
+        if written != count:
+            raise IndexFormatError('Expected {} records, got {}'.format(count, written))
+
+        heap.seek(0)
+        shutil.copyfileobj(heap, ofile)
+
+    if removed is not None:
+        ofile.write(REMOVED_MAGIC + COUNT.pack(len(removed)))
+        ofile.write(b''.join(removed))
+        if base_generation is not None:
+            ofile.write(BASE_MAGIC + base_generation)
+
+    for num in range(1, len(buckets)):
+        buckets[num] += buckets[num - 1]
+    ofile.seek(0)
+    ofile.write(HEADER.pack(MAGIC, VERSION, FLAG_RULESET if ruleset else 0, bits, key_version, count,
+                            heap_offset, heap_size, ruleset or b'\0' * 32))
+    ofile.write(struct.pack('<{}I'.format(len(buckets)), *buckets))
+
+    ofile.seek(0)
+    crc = 0
+    while True:
+        chunk = ofile.read(CRC_CHUNK)
+        if not chunk:
+            break
+        crc = zlib.crc32(chunk, crc)
+    ofile.write(TRAILER.pack(TRAILER_MAGIC, count, crc))
@@ -0,0 +1,130 @@
+"""
+index_journal.py : Append-only journal of the index changes of a checkpointed scan
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Each checkpoint appends one frame: magic, payload size and CRC32 of the
+payload. The payload is a sequence of entries (little endian):
+    K  key of a record of the previous index still present
+    R  new record: key, md5, sha1, sha256, entropy, then the sizes and
+       UTF-8 bytes of the mountpoint, path and ads
+    V  verdict: key, size and UTF-8 bytes of the rules joined by newlines
+"""
+import os
+import struct
+import zlib
+from pathlib import Path
+
+JOURNAL_MAGIC = b'SONEJRNL'
+FRAME = struct.Struct('<8sII')
+KEPT = b'K'
+RECORD = b'R'
+VERDICT = b'V'
+KEY_SIZE = 20
+RECORD_FIELDS = struct.Struct('<20s16s20s32sfHIH')
+VERDICT_FIELDS = struct.Struct('<20sI')
+
+
+class JournalError(Exception):
+    pass
+
+
+def encode_kept(out: bytearray, key: bytes):
+    out += KEPT
+    out += key
+
+
+def encode_record(out: bytearray, key: bytes, mountpoint: str, path, ads: str, md5: bytes, sha1: bytes,
+                  sha256: bytes, entropy: float):
+    """path is str or UTF-8 bytes"""
+    mountpoint = mountpoint.encode('utf-8')
+    path = path if isinstance(path, bytes) else path.encode('utf-8')
+    ads = ads.encode('utf-8')
+    out += RECORD
+    out += RECORD_FIELDS.pack(key, md5, sha1, sha256, entropy, len(mountpoint), len(path), len(ads))
+    out += mountpoint + path + ads
+
+
+def encode_verdict(out: bytearray, key: bytes, rules: list):
+    rules = '\n'.join(rules).encode('utf-8')
+    out += VERDICT
+    out += VERDICT_FIELDS.pack(key, len(rules))
+    out += rules
+
+
+def append_frame(path: Path, size: int, payload: bytes) -> int:
+    """Append a frame after the first size bytes of the journal, anything past them is dropped
+
+    Returns the new journal size.
+    """
+    with path.open('r+b' if size else 'wb') as ofile:
+        ofile.seek(size)
+        ofile.truncate()
+        ofile.write(FRAME.pack(JOURNAL_MAGIC, len(payload), zlib.crc32(payload)))
+        ofile.write(payload)
+        ofile.flush()
+        os.fsync(ofile.fileno())
+    return size + FRAME.size + len(payload)
+
+
+def _decode(payload: bytes):
+    pos = 0
+    while pos < len(payload):
+        kind = payload[pos:pos + 1]
+        pos += 1
+        if kind == KEPT:
+            yield KEPT, payload[pos:pos + KEY_SIZE]
+            pos += KEY_SIZE
+        elif kind == RECORD:
+            key, md5, sha1, sha256, entropy, mountpoint_size, path_size, ads_size = \
+                RECORD_FIELDS.unpack_from(payload, pos)
+            pos += RECORD_FIELDS.size
+            mountpoint = payload[pos:pos + mountpoint_size].decode('utf-8')
+            pos += mountpoint_size
+            path = payload[pos:pos + path_size].decode('utf-8')
+            pos += path_size
+            ads = payload[pos:pos + ads_size].decode('utf-8')
+            pos += ads_size
+            yield RECORD, key, mountpoint, path, ads, md5, sha1, sha256, entropy
+        elif kind == VERDICT:
+            key, rules_size = VERDICT_FIELDS.unpack_from(payload, pos)
+            pos += VERDICT_FIELDS.size
+            rules = payload[pos:pos + rules_size].decode('utf-8')
+            pos += rules_size
+            yield VERDICT, key, rules.split('\n') if rules else []
+        else:
+            raise JournalError('Unknown journal entry {!r}'.format(kind))
+
+
+def read_journal(path: Path, size: int):
+    """Entries of the first size bytes of the journal, as (kind, fields...) tuples"""
+    with path.open('rb') as ifile:
+        offset = 0
+        while offset < size:
+            header = ifile.read(FRAME.size)
+            if len(header) < FRAME.size:
+                raise JournalError('Truncated journal')
+            magic, payload_size, crc = FRAME.unpack(header)
+            payload = ifile.read(payload_size)
+            if magic != JOURNAL_MAGIC or len(payload) < payload_size or zlib.crc32(payload) != crc:
+                raise JournalError('Corrupt journal frame at {}'.format(offset))
+            try:
+                yield from _decode(payload)
+            except (struct.error, UnicodeDecodeError) as exc:
+                raise JournalError('Corrupt journal frame at {}: {}'.format(offset, exc)) from exc
+            offset += FRAME.size + payload_size
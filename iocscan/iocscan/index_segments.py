@@ -0,0 +1,114 @@
+"""
+index_segments.py : Base index and delta segments
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import bisect
+from pathlib import Path
+
+
+def delta_paths(base_path: Path) -> list:
+    """Delta segments of an index, oldest first"""
+    prefix = base_path.name + '.'
+    deltas = []
+    for path in base_path.parent.glob(prefix + '*'):
+        suffix = path.name[len(prefix):]
+        if suffix.isdigit():
+            deltas.append((int(suffix), path))
+    return [path for _, path in sorted(deltas)]
+
+
+def next_delta_path(base_path: Path, deltas: list) -> Path:
+    number = int(deltas[-1].name.rsplit('.', 1)[1]) + 1 if deltas else 1
+    return base_path.with_name('{}.{}'.format(base_path.name, number))
+
+
+class SegmentedIndex(object):
+    """Records of a base index overlaid by delta segments, newest last
+
+    Record numbers run across the segments. A record is live unless a newer
+    segment replaces or removes its key.
+    """
+
+    def __init__(self, base, deltas: list = None):
+        self.segments = [base] + (deltas or [])
+        self.offsets = []
+        total = 0
+        for segment in self.segments:
+            self.offsets.append(total)
+            total += len(segment)
+        self.count = total
+        self.ruleset = base.ruleset
+        self.key_version = base.key_version
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key: bytes):
+        return self.find(key) >= 0
+
+    @property
+    def base(self):
+        return self.segments[0]
+
+    @property
+    def deltas(self) -> list:
+        return self.segments[1:]
+
+    def delta_size(self) -> int:
+        """Records and removals held in the delta segments"""
+        return sum(len(delta) + delta.removed_count for delta in self.deltas)
+
+    def __locate(self, num: int):
+        pos = bisect.bisect_right(self.offsets, num) - 1
+        return self.segments[pos], num - self.offsets[pos]
+
+    def find(self, key: bytes) -> int:
+        for pos in range(len(self.segments) - 1, -1, -1):
+            segment = self.segments[pos]
+            num = segment.find(key)
+            if num >= 0:
+                return self.offsets[pos] + num
+            if segment.is_removed(key):
+                return -1
+        return -1
+
+    def ranges(self):
+        """(first record number, record count) of each segment"""
+        return [(offset, len(segment)) for offset, segment in zip(self.offsets, self.segments)]
+
+    def is_live(self, num: int) -> bool:
+        if num >= self.offsets[-1]:
+            return True
+        return self.find(self.key(num)) == num
+
+    def key(self, num: int) -> bytes:
+        segment, num = self.__locate(num)
+        return segment.key(num)
+
+    def raw_fields(self, num: int) -> tuple:
+        segment, num = self.__locate(num)
+        return segment.raw_fields(num)
+
+    def verdict_at(self, num: int):
+        segment, num = self.__locate(num)
+        return segment.verdict_at(num)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
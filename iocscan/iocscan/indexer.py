@@ -0,0 +1,557 @@
+"""
+indexer.py : File index shared by the scanners
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+import heapq
+import logging
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from array import array
+from pathlib import Path
+
+from epclib.common.compressor import Decompressor
+from .index_codec import BLOCK_MAGIC, CodecError, get_codec, write_blocks
+from .index_diff import IndexDiff, unset_bits
+from .index_format import MAGIC, IndexFormatError, MappedIndex, commit_file, write_index
+from .index_journal import KEPT, RECORD, append_frame, encode_kept, encode_record, encode_verdict, read_journal
+from .index_segments import SegmentedIndex, delta_paths, next_delta_path
+from .indx_reader import IndexReader
+from .record_table import RecordTable
+
+# Optional section following the SONEINDX records, ignored by older readers
+VERDICT_MAGIC = b'SONEYARA'
+
+# 0: sha1 of the formatted inode, mtime and path, 1: see stream_key
+KEY_VERSION = 1
+KEY = struct.Struct('<QdI')
+KEY_FIELD = '_key'
+LEGACY_KEY_FIELD = '_legacy_key'
+
+
+def digest_bytes(value, hash_name: str) -> bytes:
+    """Raw digest of a hash object, or of a digest loaded from a previous index"""
+    if value is None:
+        return b'0' * hashlib.new(hash_name).digest_size
+    if isinstance(value, bytes):
+        return value
+    return value.digest()
+
+
+def _timestamp(value) -> float:
+    return value.timestamp() if hasattr(value, 'timestamp') else float(value or 0)
+
+
+def stream_key(data: dict) -> bytes:
+    """Index key of a stream record: inode, mtime and a CRC32 of the path and ADS, cached in the record"""
+    key = data.get(KEY_FIELD)
+    if key is None:
+        location = zlib.crc32(data.get('ads', '').encode('utf-8'), zlib.crc32(data['path'].encode('utf-8')))
+        key = data[KEY_FIELD] = KEY.pack(int(data.get('inode') or 0) & 0xFFFFFFFFFFFFFFFF,
+                                         _timestamp(data.get('mtime')), location)
+    return key
+
+
+def legacy_stream_key(data: dict) -> bytes:
+    """Key of the indexes written before KEY_VERSION 1"""
+    key = data.get(LEGACY_KEY_FIELD)
+    if key is None:
+        key = data[LEGACY_KEY_FIELD] = hashlib.sha1('{inode}{mtime}{path}'.format(**data).encode('utf-8')).digest()
+    return key
+
+
+def stream_record(mountpoint, fobj, ads, stream: dict) -> dict:
+    """Build the index record of one file stream"""
+    if not ads or ads == '$Data':
+        ads_txt = ''
+    else:
+        ads_txt = ':{}'.format(ads)
+
+    data = dict(
+        mountpoint=mountpoint,
+        path=fobj.path.as_posix(),
+        ads=ads_txt,
+    )
+    data.update(stream)
+    return data
+
+
+class LegacyIndex(object):
+    """SONEINDX v1 index, parsed in memory, only read to migrate to v2"""
+    key_version = 0
+    generation = None
+
+    def __init__(self, data: bytes = None):
+        self.records = []
+        self.rows = dict()
+        self.verdicts = dict()
+        self.ruleset = None
+        if data is None:
+            return
+        reader = IndexReader(data)
+        for record in sorted(reader, key=lambda record: record.key):
+            self.rows[record.key] = len(self.records)
+            self.records.append((record.key,) + record.fields())
+        self.__parse_verdicts(reader.remainder())
+
+    def __parse_verdicts(self, data: bytes):
+        if not data.startswith(VERDICT_MAGIC):
+            return
+        pos = len(VERDICT_MAGIC)
+        self.ruleset = data[pos:pos + 32]
+        count, = struct.unpack_from('<L', data, pos + 32)
+        pos += 36
+        for _ in range(count):
+            key = data[pos:pos + 20]
+            end = data.index(b'\0', pos + 20)
+            rules = data[pos + 20:end].decode('utf-8')
+            self.verdicts[key] = rules.split('\n') if rules else []
+            pos = end + 1
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, key: bytes):
+        return key in self.rows
+
+    def find(self, key: bytes) -> int:
+        return self.rows.get(key, -1)
+
+    def is_removed(self, key: bytes) -> bool:
+        return False
+
+    def key(self, num: int) -> bytes:
+        return self.records[num][0]
+
+    def raw_fields(self, num: int) -> tuple:
+        return self.records[num][1:]
+
+    def verdict_at(self, num: int):
+        return self.verdicts.get(self.records[num][0])
+
+    def verdict(self, key: bytes):
+        return self.verdicts.get(key)
+
+    def close(self):
+        pass
+
+
+def open_index(path: Path):
+    """Open a v2 index in place, compressed or not, or load a v1 one"""
+    with path.open('rb') as ifile:
+        magic = ifile.read(len(MAGIC))
+        if magic not in (MAGIC, BLOCK_MAGIC):
+            ifile.seek(0)
+            header = ifile.read(4)
+            try:
+                decompressor = Decompressor.from_header(header)
+                return LegacyIndex(decompressor.decompress(ifile.read()))
+            except Exception as exc:
+                # v1 files have no checksum, any parsing failure means corruption
+                raise IndexFormatError('Invalid v1 index: {}'.format(exc)) from exc
+    try:
+        return MappedIndex(path)
+    except (ValueError, struct.error) as exc:
+        raise IndexFormatError(str(exc)) from exc
+
+
+class Indexer(object):
+    """Index of the scanned streams
+
+    Records of the previous index are only referenced by their number, a
+    bitmap tells which ones are still present. New and changed records are
+    kept in a RecordTable.
+
+    A scan writes its changes as a delta segment next to the base index,
+    the segments are compacted into a new base once there are more than
+    max_deltas of them or they hold more than compact_ratio of the base.
+    The replaced base is kept as the previous generation, used when the
+    current one fails validation.
+
+    An index with older keys is looked up with its own keys and migrated:
+    every record seen is copied to the new index under its new key.
+
+    New segments are block compressed with codec ('none', 'zlib', 'lzma' or
+    'zstd'), segments written with another codec stay readable.
+    """
+
+    def __init__(self, max_deltas: int = 8, compact_ratio: float = 0.1, codec: str = 'none',
+                 codec_level: int = None):
+        self.__lock = threading.Lock()
+        try:
+            self.__codec = get_codec(codec)
+        except CodecError as exc:
+            logging.warning("%s, writing an uncompressed index", exc)
+            self.__codec = None
+        self.__codec_level = int(codec_level) if codec_level is not None else None
+        self.__changes = 0
+        self.__max_deltas = max_deltas
+        self.__compact_ratio = compact_ratio
+        self.__index_path = Path('iocscan.index')
+        self.__previous_path = self.__index_path.with_name(self.__index_path.name + '.prev')
+        self.__delta_paths = delta_paths(self.__index_path)
+        self.__rewrite = False
+        self.__base_valid = False
+        self.__old_index = self.__open()
+        self.__migrating = len(self.__old_index) > 0 and self.__old_index.key_version != KEY_VERSION
+        self.__old_key = legacy_stream_key if self.__migrating else stream_key
+        if self.__migrating:
+            self.__rewrite = True
+        if self.__rewrite:
+            self.__changes += 1
+        self.__kept = bytearray((len(self.__old_index) + 7) // 8)
+        self.__kept_count = 0
+        self.__old_verdicts = True
+        # Verdicts of this run for records of the previous index
+        self.__kept_verdicts = None
+        self.__table = RecordTable()
+        self.__ruleset = None
+        # Size of the checkpoint journal, None until the first checkpoint
+        self.__journal_size = None
+        # Changes since the last checkpoint: kept record numbers, rows with new fields or verdicts
+        self.__kept_log = array('I')
+        self.__row_log = array('I')
+        self.__verdict_log = array('I')
+        self.__kept_verdict_log = array('I')
+
+    def __open(self) -> SegmentedIndex:
+        """Last valid generation of the index"""
+        for path in (self.__index_path, self.__previous_path):
+            if not path.exists():
+                continue
+            try:
+                base = open_index(path)
+            except (OSError, IndexFormatError) as exc:
+                logging.error("Discarding index %s: %s", path, exc)
+                self.__rewrite = True
+                continue
+            if isinstance(base, LegacyIndex):
+                # Migrate to v2 even if nothing changed
+                self.__rewrite = True
+            if path == self.__index_path:
+                self.__base_valid = True
+            else:
+                # The deltas were written on top of the lost base, the next write compacts them away
+                logging.warning("Using previous index generation %s", path)
+                self.__rewrite = True
+                return SegmentedIndex(base)
+            deltas = []
+            for delta_path in self.__delta_paths:
+                try:
+                    delta = MappedIndex(delta_path)
+                except (OSError, ValueError, struct.error, IndexFormatError) as exc:
+                    # Newer deltas depend on this one, drop them too
+                    logging.error("Discarding index delta %s and newer: %s", delta_path, exc)
+                    self.__rewrite = True
+                    break
+                if delta.base_generation is not None and delta.base_generation != base.generation:
+                    # Left behind by a compaction interrupted after the new base was committed
+                    logging.error("Discarding index delta %s and newer: written on another base", delta_path)
+                    delta.close()
+                    self.__rewrite = True
+                    break
+                deltas.append(delta)
+            return SegmentedIndex(base, deltas)
+        return SegmentedIndex(LegacyIndex())
+
+    def __is_kept(self, num: int) -> bool:
+        return self.__kept[num >> 3] & (1 << (num & 7)) != 0
+
+    def __keep(self, num: int):
+        if not self.__is_kept(num):
+            self.__kept[num >> 3] |= 1 << (num & 7)
+            self.__kept_count += 1
+            if self.__journal_size is not None:
+                self.__kept_log.append(num)
+
+    def __log(self, log: array, row: int):
+        if self.__journal_size is not None:
+            log.append(row)
+
+    def in_index(self, data: dict):
+        return self.__old_index.find(self.__old_key(data)) >= 0
+
+    def index(self, data: dict):
+        num = self.__old_index.find(self.__old_key(data))
+        key = stream_key(data)
+        with self.__lock:
+            if num >= 0 and not self.__migrating:
+                self.__keep(num)
+                return
+            row = self.__table.row(key)
+            if self.__table.is_indexed(row):
+                return
+            if num >= 0:
+                mountpoint, path, ads, md5, sha1, sha256, entropy = self.__old_index.raw_fields(num)
+                self.__table.set_fields(row, data.get('mountpoint', ''), data.get('path', ''), data.get('ads', ''),
+                                        md5, sha1, sha256, entropy)
+                self.__log(self.__row_log, row)
+                if self.__table.verdict(row) is None and self.__old_verdict(num) is not None:
+                    self.__table.set_verdict(row, self.__old_verdict(num))
+                return
+            self.__table.set_fields(row, data.get('mountpoint', ''), data.get('path', ''), data.get('ads', ''),
+                                    *[digest_bytes(data.get(name), name) for name in ['md5', 'sha1', 'sha256']],
+                                    entropy=data.get('entropy', 0.0))
+            self.__log(self.__row_log, row)
+            self.__changes += 1
+
+    @property
+    def ruleset(self) -> bytes:
+        """Fingerprint of the rules the verdicts of this run are tracked for, None if they are not"""
+        return self.__ruleset
+
+    def set_ruleset(self, fingerprint: bytes):
+        """Enable verdict tracking for the given ruleset fingerprint"""
+        self.__ruleset = fingerprint
+        if fingerprint != self.__old_index.ruleset:
+            self.__old_verdicts = False
+            self.__changes += 1
+
+    def __old_verdict(self, num: int):
+        return self.__old_index.verdict_at(num) if self.__old_verdicts and num >= 0 else None
+
+    def get_verdict(self, data: dict):
+        """Last yara verdict (list of rules) of an unchanged stream, None if unknown"""
+        if self.__ruleset is None:
+            return None
+        return self.__old_verdict(self.__old_index.find(self.__old_key(data)))
+
+    def __set_verdict(self, key: bytes, rules: list):
+        num = self.__old_index.find(key) if not self.__migrating else -1
+        if num < 0:
+            row = self.__table.row(key)
+            self.__table.set_verdict(row, rules)
+            self.__log(self.__verdict_log, row)
+            self.__changes += 1
+            return
+        if self.__kept_verdicts is None:
+            self.__kept_verdicts = RecordTable()
+        row = self.__kept_verdicts.row(key)
+        self.__kept_verdicts.set_verdict(row, rules)
+        self.__log(self.__kept_verdict_log, row)
+        if self.__old_verdict(num) != rules:
+            self.__changes += 1
+
+    def set_verdict(self, data: dict, rules: list):
+        if self.__ruleset is None:
+            return
+        key = self.__old_key(data) if not self.__migrating else stream_key(data)
+        with self.__lock:
+            self.__set_verdict(key, rules)
+
+    def seen(self, data: dict) -> bool:
+        """True if the stream was already indexed during this run"""
+        num = self.__old_index.find(self.__old_key(data)) if not self.__migrating else -1
+        if num >= 0:
+            return self.__is_kept(num)
+        return self.__table.is_indexed(self.__table.find(stream_key(data)))
+
+    def __verdicts(self):
+        for table in (self.__table, self.__kept_verdicts):
+            if table is None:
+                continue
+            for row in range(len(table)):
+                rules = table.verdict(row)
+                if rules is not None:
+                    yield table.key(row), rules
+
+    def save_checkpoint(self, journal_path: Path) -> dict:
+        """Append the changes since the last checkpoint to journal_path
+
+        The first checkpoint of a run journals everything done so far, the
+        next ones only what changed since, so a checkpoint costs the same
+        late in a long scan as early in it.
+        """
+        with self.__lock:
+            table = self.__table
+            kept_verdicts = self.__kept_verdicts
+            if self.__journal_size is None:
+                kept = (num for num in range(len(self.__old_index)) if self.__is_kept(num))
+                rows = (row for row in range(len(table)) if table.is_indexed(row))
+                verdicts = range(len(table))
+                kept_verdict_rows = range(len(kept_verdicts)) if kept_verdicts is not None else ()
+            else:
+                kept, rows, verdicts, kept_verdict_rows = (self.__kept_log, self.__row_log, self.__verdict_log,
+                                                           self.__kept_verdict_log)
+            payload = bytearray()
+            for num in kept:
+                encode_kept(payload, self.__old_index.key(num))
+            for row in rows:
+                encode_record(payload, table.key(row), *table.fields(row))
+            for source, source_rows in ((table, verdicts), (kept_verdicts, kept_verdict_rows)):
+                for row in source_rows:
+                    rules = source.verdict(row)
+                    if rules is not None:
+                        encode_verdict(payload, source.key(row), rules)
+            self.__journal_size = append_frame(journal_path, self.__journal_size or 0, payload)
+            for log in (self.__kept_log, self.__row_log, self.__verdict_log, self.__kept_verdict_log):
+                del log[:]
+            return dict(
+                changes=self.__changes,
+                journal_size=self.__journal_size,
+                ruleset=self.__ruleset.hex() if self.__ruleset is not None else None
+            )
+
+    def restore_checkpoint(self, state: dict, journal_path: Path):
+        with self.__lock:
+            for entry in read_journal(journal_path, state['journal_size']):
+                if entry[0] == KEPT:
+                    num = self.__old_index.find(entry[1])
+                    if num >= 0:
+                        self.__keep(num)
+                elif entry[0] == RECORD:
+                    self.__table.set_fields(self.__table.row(entry[1]), *entry[2:])
+                else:
+                    self.__set_verdict(entry[1], entry[2])
+            self.__changes = state['changes']
+            # Later checkpoints append to the journal restored here
+            self.__journal_size = state['journal_size']
+
+    def __entries(self, changed_verdicts: list = None):
+        """Records of the new index, or of a delta segment, by increasing key"""
+        old_index = self.__old_index
+        table = self.__table
+        tracked = self.__ruleset is not None
+
+        def kept_verdict(key: bytes, num: int):
+            if not tracked:
+                return None
+            row = self.__kept_verdicts.find(key) if self.__kept_verdicts is not None else -1
+            return self.__kept_verdicts.verdict(row) if row >= 0 else self.__old_verdict(num)
+
+        def kept(first: int, count: int):
+            for num in range(first, first + count):
+                if self.__is_kept(num):
+                    key = old_index.key(num)
+                    yield (key,) + old_index.raw_fields(num) + (kept_verdict(key, num),)
+
+        def changed():
+            for key, num in changed_verdicts:
+                yield (key,) + old_index.raw_fields(num) + (kept_verdict(key, num),)
+
+        def added():
+            for row in table.sorted_rows():
+                yield (table.key(row),) + table.fields(row) + (table.verdict(row) if tracked else None,)
+
+        if changed_verdicts is not None:
+            return heapq.merge(changed(), added())
+        return heapq.merge(*[kept(first, count) for first, count in old_index.ranges()] + [added()])
+
+    def records_changed(self) -> bool:
+        """True if records were added, changed or removed since the previous index, verdicts aside
+
+        Also True when the previous index was migrated, recovered or discarded.
+        """
+        return self.__rewrite or 1 in self.__table.indexed or bool(self.__removed())
+
+    def records(self):
+        """(mountpoint, path, ads, md5, sha1, sha256, entropy) of every record of the new index, by key
+
+        Must be called before write.
+        """
+        for entry in self.__entries():
+            yield entry[1:8]
+
+    def __removed(self) -> list:
+        """Numbers of the previous records that were not seen during this run"""
+        old_index = self.__old_index
+        return [num for num in unset_bits(self.__kept, len(old_index)) if old_index.is_live(num)]
+
+    def __removed_keys(self) -> list:
+        return sorted(self.__old_index.key(num) for num in self.__removed())
+
+    def diff(self):
+        """Changes since the previous index, None if there is no previous index
+
+        Must be called before write. Also None while migrating keys, every
+        record would show as modified.
+        """
+        if not len(self.__old_index) or self.__migrating:
+            return None
+        with self.__lock:
+            old_records = [self.__old_index.raw_fields(num) for num in self.__removed()]
+            new_records = [self.__table.fields(row) for row in range(len(self.__table))
+                           if self.__table.is_indexed(row)]
+        return IndexDiff.from_records(old_records, new_records)
+
+    def __changed_verdicts(self) -> list:
+        """(key, record number) of the kept records whose verdict changed, by key"""
+        changed = []
+        if self.__ruleset is None or self.__kept_verdicts is None:
+            return changed
+        for row in range(len(self.__kept_verdicts)):
+            key = self.__kept_verdicts.key(row)
+            num = self.__old_index.find(key)
+            if num >= 0 and self.__is_kept(num) and self.__kept_verdicts.verdict(row) != self.__old_verdict(num):
+                changed.append((key, num))
+        changed.sort()
+        return changed
+
+    def __needs_compaction(self, delta_size: int) -> bool:
+        old_index = self.__old_index
+        return (self.__rewrite or not self.__old_verdicts or
+                len(old_index.deltas) >= self.__max_deltas or
+                old_index.delta_size() + delta_size > self.__compact_ratio * len(old_index.base))
+
+    def write(self):
+        removed = self.__removed_keys()
+        self.__changes += len(removed)
+
+        if self.__changes == 0:
+            return
+
+        added = sum(self.__table.indexed)
+        changed = self.__changed_verdicts()
+        base_generation = None
+        if self.__needs_compaction(added + len(changed) + len(removed)):
+            path = self.__index_path
+            count = self.__kept_count + added
+            entries = self.__entries()
+            removed = None
+        else:
+            path = next_delta_path(self.__index_path, self.__delta_paths)
+            count = added + len(changed)
+            entries = self.__entries(changed)
+            base_generation = self.__old_index.base.generation
+
+        tmp_path = path.with_name(path.name + '.tmp')
+        with tmp_path.open('w+b') as ofile:
+            if self.__codec is None:
+                write_index(ofile, count, entries, self.__ruleset, removed, KEY_VERSION, base_generation)
+            else:
+                with tempfile.TemporaryFile() as raw:
+                    write_index(raw, count, entries, self.__ruleset, removed, KEY_VERSION, base_generation)
+                    write_blocks(raw, ofile, self.__codec, self.__codec_level)
+            ofile.flush()
+            os.fsync(ofile.fileno())
+        # The previous index is mapped, it must be released before being replaced
+        self.__old_index.close()
+        self.__old_index = SegmentedIndex(LegacyIndex())
+        if path == self.__index_path:
+            if self.__base_valid:
+                commit_file(path, self.__previous_path)
+            commit_file(tmp_path, path)
+            # The deltas are merged in the new base
+            for delta_path in self.__delta_paths:
+                os.remove(str(delta_path))
+        else:
+            commit_file(tmp_path, path)
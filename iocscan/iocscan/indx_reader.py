@@ -0,0 +1,197 @@
+"""
+indx_reader.py : Lazy reader for SONEINDX v1 indexes
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Same layout as indx_parser.FileIndex: header (magic, version, count) then
+count records of key, null terminated mountpoint, path and ads, md5, sha1,
+sha256 and entropy.
+"""
+import struct
+from array import array
+
+from epclib.common.compressor import Decompressor
+
+MAGIC = b'SONEINDX'
+HEADER = struct.Struct('<8sBI')
+KEY_SIZE = 20
+RECORD_TAIL = struct.Struct('<16s20s32sf')
+CHUNK_SIZE = 1024 * 1024
+
+
+class IndexRecord(object):
+    """One v1 record, strings are decoded on first access"""
+    __slots__ = ('key', 'raw_mountpoint', 'raw_path', 'raw_ads', 'md5', 'sha1', 'sha256', 'entropy')
+
+    def __init__(self, key, raw_mountpoint, raw_path, raw_ads, md5, sha1, sha256, entropy):
+        self.key = key
+        self.raw_mountpoint = raw_mountpoint
+        self.raw_path = raw_path
+        self.raw_ads = raw_ads
+        self.md5 = md5
+        self.sha1 = sha1
+        self.sha256 = sha256
+        self.entropy = entropy
+
+    @property
+    def mountpoint(self) -> str:
+        return self.raw_mountpoint.decode('utf-8')
+
+    @property
+    def path(self) -> str:
+        return self.raw_path.decode('utf-8')
+
+    @property
+    def ads(self) -> str:
+        return self.raw_ads.decode('utf-8')
+
+    def fields(self) -> tuple:
+        """(mountpoint, path, ads, md5, sha1, sha256, entropy), strings undecoded"""
+        return self.raw_mountpoint, self.raw_path, self.raw_ads, self.md5, self.sha1, self.sha256, self.entropy
+
+
+def parse_header(data) -> int:
+    """Record count of a v1 index"""
+    magic, version, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != 1:
+        raise ValueError('Not a SONEINDX v1 index')
+    return count
+
+
+def _string_end(data, pos: int) -> int:
+    # find rather than index, mmap has no index
+    end = data.find(b'\0', pos)
+    if end < 0:
+        raise ValueError('Truncated record')
+    return end
+
+
+def skip_record(data, pos: int) -> int:
+    """Offset of the record following the one at pos"""
+    pos = _string_end(data, pos + KEY_SIZE) + 1
+    pos = _string_end(data, pos) + 1
+    pos = _string_end(data, pos) + 1
+    return pos + RECORD_TAIL.size
+
+
+def parse_record(data, pos: int):
+    """(record, offset of the next one), IndexError or ValueError on truncated data"""
+    key = bytes(data[pos:pos + KEY_SIZE])
+    pos += KEY_SIZE
+    strings = []
+    for _ in range(3):
+        end = _string_end(data, pos)
+        strings.append(bytes(data[pos:end]))
+        pos = end + 1
+    if pos + RECORD_TAIL.size > len(data):
+        raise IndexError('Truncated record')
+    return IndexRecord(key, *(strings + list(RECORD_TAIL.unpack_from(data, pos)))), pos + RECORD_TAIL.size
+
+
+class IndexReader(object):
+    """Random access to the records of a decompressed v1 index
+
+    Records are parsed when iterated or looked up, the offset table needed
+    for lookups by number is built on first use.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.count = parse_header(data)
+        self.__offsets = None
+        self.__end = None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        pos = HEADER.size
+        for _ in range(self.count):
+            record, pos = parse_record(self.data, pos)
+            yield record
+        self.__end = pos
+
+    def keys(self):
+        pos = HEADER.size
+        for _ in range(self.count):
+            yield bytes(self.data[pos:pos + KEY_SIZE])
+            pos = skip_record(self.data, pos)
+        self.__end = pos
+
+    def offsets(self) -> array:
+        if self.__offsets is None:
+            offsets = array('Q')
+            pos = HEADER.size
+            for _ in range(self.count):
+                offsets.append(pos)
+                pos = skip_record(self.data, pos)
+            self.__offsets = offsets
+            self.__end = pos
+        return self.__offsets
+
+    def __getitem__(self, num: int) -> IndexRecord:
+        if not 0 <= num < self.count:
+            raise IndexError(num)
+        return parse_record(self.data, self.offsets()[num])[0]
+
+    def remainder(self):
+        """Data following the records"""
+        if self.__end is None:
+            self.offsets()
+        return self.data[self.__end:]
+
+
+def iter_records(ifile, keys_only: bool = False, chunk_size: int = CHUNK_SIZE):
+    """Stream the records, or only the keys, of a compressed v1 index file
+
+    Only one chunk of decompressed data is held at a time.
+    """
+    decompressor = Decompressor.from_header(ifile.read(4))
+    buffer = bytearray()
+
+    def fill() -> bool:
+        chunk = ifile.read(chunk_size)
+        if not chunk:
+            return False
+        buffer.extend(decompressor.decompress(chunk))
+        return True
+
+    while len(buffer) < HEADER.size:
+        if not fill():
+            raise ValueError('Truncated index')
+    count = parse_header(buffer)
+    pos = HEADER.size
+    for _ in range(count):
+        while True:
+            try:
+                if keys_only:
+                    end = skip_record(buffer, pos)
+                    if end > len(buffer):
+                        raise IndexError('Truncated record')
+                    item = bytes(buffer[pos:pos + KEY_SIZE])
+                else:
+                    item, end = parse_record(buffer, pos)
+                break
+            except (IndexError, ValueError):
+                if not fill():
+                    raise ValueError('Truncated index')
+        yield item
+        pos = end
+        if pos > chunk_size:
+            del buffer[:pos]
+            pos = 0
@@ -27,7 +27,20 @@ from epc.common.data import DataClient
 from epc.common.settings import Config
 from epclib.common.iapp import App
 from epclib.filesystem.drive import DriveManager
+from .checkpoint import ScanCheckpoint
+from .content_cache import ContentCache
+from .detection import serialize_batch
+from .hash_index import is_valid as is_valid_hash_index, save_hash_index
+from .hash_scanner import HashScanner
+from .index_journal import JournalError
+from .indexer import Indexer, stream_record
 from .metadata_scanner import MetadataScanner
+from .metrics import ScanMetrics
+from .path_filter import PathFilter
+from .pipeline import ScanPipeline
+from .report_spool import ReportSpool
+from .throttle import Throttle
+from .yara_pool import pool_size
 from .yara_scanner import YaraScanner
 
 DEFAULT_CONFIGS = dict(
@@ -38,8 +51,47 @@ DEFAULT_CONFIGS = dict(
         EXCLUDE_FILES=['pagefile.sys', 'hiberfil.sys', 'swapfile.sys'],
         EXCLUDE_DIRS=[],
         RULES_FILE='yara_rules',
+        RULES_CACHE=True,
+        RULES_CACHE_TTL=7 * 24 * 3600,
+        RULESETS=None,
+        YARA_PROFILE=False,
+        YARA_PROFILE_TOP=20,
+        YARA_TIMEOUT=60,
+        YARA_TIMEOUT_REPORT_MAX=1000,
+        YARA_LARGE_FILES=True,
+        YARA_LARGE_TIMEOUT=300,
+        YARA_WINDOW_MB=16,
+        YARA_WINDOW_OVERLAP_KB=64,
+        YARA_EDGE_MB=4,
+        YARA_POOL_WORKERS=0,
+        YARA_POOL_BATCH=8,
         REPORTING_MODE='standard',
-        INCLUDE_DELETED=False
+        INCLUDE_DELETED=False,
+        INCREMENTAL_YARA=True,
+        SCAN_WORKERS=4,
+        PROCESS_WORKERS=4,
+        QUEUE_DEPTH=256,
+        SHARED_READ_MAX=64,
+        REPORT_BUFFER=1000,
+        REPORT_BATCH_KB=1024,
+        THROTTLE_READ_MBPS=0,
+        THROTTLE_CPU_PERCENT=100,
+        THROTTLE_LOW_PRIORITY=True,
+        THROTTLE_ADAPTIVE=True,
+        THROTTLE_MAX_LOAD=0.75,
+        CHECKPOINT_INTERVAL=300,
+        CHECKPOINT_MAX_AGE=7 * 24 * 3600,
+        INDEX_MAX_DELTAS=8,
+        INDEX_COMPACT_RATIO=0.1,
+        INDEX_CODEC='none',
+        INDEX_CODEC_LEVEL=None,
+        DEDUP_CACHE=False,
+        DEDUP_CACHE_SIZE=100000,
+        CHANGE_REPORT=True,
+        CHANGE_REPORT_MAX=10000,
+        HASH_INDEX=True,
+        HASH_IOCS=None,
+        HASH_IOCS_FILE=None
     ),
     unix=dict(
         MAX_SIZE=256,
@@ -49,8 +101,47 @@ DEFAULT_CONFIGS = dict(
             '/proc', '/run', '/dev',
             '.git'],
         RULES_FILE='yara_rules',
+        RULES_CACHE=True,
+        RULES_CACHE_TTL=7 * 24 * 3600,
+        RULESETS=None,
+        YARA_PROFILE=False,
+        YARA_PROFILE_TOP=20,
+        YARA_TIMEOUT=60,
+        YARA_TIMEOUT_REPORT_MAX=1000,
+        YARA_LARGE_FILES=True,
+        YARA_LARGE_TIMEOUT=300,
+        YARA_WINDOW_MB=16,
+        YARA_WINDOW_OVERLAP_KB=64,
+        YARA_EDGE_MB=4,
+        YARA_POOL_WORKERS=0,
+        YARA_POOL_BATCH=8,
         REPORTING_MODE='standard',
-        INCLUDE_DELETED=False
+        INCLUDE_DELETED=False,
+        INCREMENTAL_YARA=True,
+        SCAN_WORKERS=4,
+        PROCESS_WORKERS=4,
+        QUEUE_DEPTH=256,
+        SHARED_READ_MAX=64,
+        REPORT_BUFFER=1000,
+        REPORT_BATCH_KB=1024,
+        THROTTLE_READ_MBPS=0,
+        THROTTLE_CPU_PERCENT=100,
+        THROTTLE_LOW_PRIORITY=True,
+        THROTTLE_ADAPTIVE=True,
+        THROTTLE_MAX_LOAD=0.75,
+        CHECKPOINT_INTERVAL=300,
+        CHECKPOINT_MAX_AGE=7 * 24 * 3600,
+        INDEX_MAX_DELTAS=8,
+        INDEX_COMPACT_RATIO=0.1,
+        INDEX_CODEC='none',
+        INDEX_CODEC_LEVEL=None,
+        DEDUP_CACHE=False,
+        DEDUP_CACHE_SIZE=100000,
+        CHANGE_REPORT=True,
+        CHANGE_REPORT_MAX=10000,
+        HASH_INDEX=True,
+        HASH_IOCS=None,
+        HASH_IOCS_FILE=None
     ),
     android=dict(
         MAX_SIZE=256,
@@ -60,12 +151,56 @@ DEFAULT_CONFIGS = dict(
             '/proc', '/run', '/dev',
             '/sdcard/DCIM', '/sdcard/Android'],
         RULES_FILE='yara_rules',
+        RULES_CACHE=True,
+        RULES_CACHE_TTL=7 * 24 * 3600,
+        RULESETS=None,
+        YARA_PROFILE=False,
+        YARA_PROFILE_TOP=20,
+        YARA_TIMEOUT=60,
+        YARA_TIMEOUT_REPORT_MAX=1000,
+        YARA_LARGE_FILES=False,
+        YARA_LARGE_TIMEOUT=300,
+        YARA_WINDOW_MB=16,
+        YARA_WINDOW_OVERLAP_KB=64,
+        YARA_EDGE_MB=4,
+        YARA_POOL_WORKERS=0,
+        YARA_POOL_BATCH=8,
         REPORTING_MODE='standard',
-        INCLUDE_DELETED=False
+        INCLUDE_DELETED=False,
+        INCREMENTAL_YARA=True,
+        SCAN_WORKERS=1,
+        PROCESS_WORKERS=2,
+        QUEUE_DEPTH=32,
+        SHARED_READ_MAX=16,
+        REPORT_BUFFER=100,
+        REPORT_BATCH_KB=256,
+        THROTTLE_READ_MBPS=20,
+        THROTTLE_CPU_PERCENT=50,
+        THROTTLE_LOW_PRIORITY=True,
+        THROTTLE_ADAPTIVE=True,
+        THROTTLE_MAX_LOAD=0.75,
+        CHECKPOINT_INTERVAL=120,
+        CHECKPOINT_MAX_AGE=7 * 24 * 3600,
+        INDEX_MAX_DELTAS=8,
+        INDEX_COMPACT_RATIO=0.1,
+        INDEX_CODEC='zlib',
+        INDEX_CODEC_LEVEL=6,
+        DEDUP_CACHE=False,
+        DEDUP_CACHE_SIZE=10000,
+        CHANGE_REPORT=True,
+        CHANGE_REPORT_MAX=1000,
+        HASH_INDEX=False,
+        HASH_IOCS=None,
+        HASH_IOCS_FILE=None
     )
 )
 
 
+def _report_sort_key(item: dict):
+    """Stable ordering for reports produced by the pipeline workers, older runs first"""
+    return item.get('timestamp') or '', item.get('filepath') or '', item.get('rule') or ''
+
+
 class IocScanApp(App):
     """Simple IOC Scanning app (match yara rules on interesting exts)"""
 
@@ -74,63 +209,208 @@ class IocScanApp(App):
         self.cur_data = None
         self.cur_data_pos = 0
         self.config = DEFAULT_CONFIGS.get(platform)
-        self.report = []
+        self.report = None
         self.state = dict()
         self.scanners = []
-
-    def __recursion_callback(self, item: Path):
-        posix_path = item.as_posix()
-        path = posix_path[3:] if Config().PLATFORM == 'win32' and posix_path[1] == ':' else posix_path
-        for excl in self.config.get('EXCLUDE_DIRS'):
-            if path.startswith(excl):
-                return False
-        return True
+        self.path_filter = None
+        self.indexer = None
+        self.checkpoint = ScanCheckpoint()
+        self.pipeline = None
+        self.stop_requested = False
+        self.metrics = ScanMetrics()
 
     def _run(self, *args, **kwargs) -> int:
-        self.config.update({k: v for k, v in kwargs.get('config', {}).items() if v})
+        # A stop requested during a previous run must not abort this one
+        self.stop_requested = False
+        self.scanners = []
+        try:
+            return self.__scan(**kwargs)
+        finally:
+            # Interrupted or failed scans never reach finalize
+            for scanner in self.scanners:
+                if isinstance(scanner, YaraScanner):
+                    scanner.close()
+
+    def __scan(self, **kwargs) -> int:
+        self.config.update({k: v for k, v in kwargs.get('config', {}).items() if v is not None})
         self.config['timestamp'] = arrow.utcnow().isoformat()
 
+        resume = self.checkpoint.load(self.config.get('CHECKPOINT_MAX_AGE', 7 * 24 * 3600))
+        if resume:
+            self.logger.info("Resuming IOCScan started at %s", resume['timestamp'])
+            self.config['timestamp'] = resume['timestamp']
+
         self.logger.debug("IOCScan running with %s", self.config)
 
         scan_classes = [
             YaraScanner,
             MetadataScanner
         ]
+        hash_iocs = self.config.get('HASH_IOCS') or self.config.get('HASH_IOCS_FILE')
+        if hash_iocs:
+            scan_classes.append(HashScanner)
 
         drivemanager = DriveManager()
+        self.__open_index()
+        self.report = ReportSpool(Path('iocscan.spool'),
+                                  buffer_size=int(self.config.get('REPORT_BUFFER', 1000)),
+                                  batch_size=int(self.config.get('REPORT_BATCH_KB', 1024)) * 1024,
+                                  sort_key=_report_sort_key)
+        self.path_filter = PathFilter(self.config, strip_drive=Config().PLATFORM == 'win32', metrics=self.metrics)
+        cache = None
+        if self.config.get('DEDUP_CACHE'):
+            cache = ContentCache(int(self.config.get('DEDUP_CACHE_SIZE', 100000)))
 
-        for scan_class in scan_classes:
-            scanner = scan_class(self.config)
-            scanner.init()
-            self.scanners.append(scanner)
+        self.__init_scanners(scan_classes)
 
+        if resume:
+            resume = self.__restore(resume, scan_classes)
+            if resume is None:
+                self.config['timestamp'] = arrow.utcnow().isoformat()
+
+        units = []
         for drivepath, mountpoint in drivemanager.list_available():
-            try:
-                self.logger.info("Scanning %s | %s", drivepath, mountpoint)
-                drive = drivemanager.open(drivepath, mountpoint)
-                for fobj in drive.enumerate_files(directory=self.config["SCAN_ROOTS"],
-                                                  recurse_callback=self.__recursion_callback):
-                    for scanner in self.scanners:
-                        scanner.process(mountpoint, fobj)
+            # Split each drive along SCAN_ROOTS so large volumes can be walked concurrently
+            roots = self.config["SCAN_ROOTS"]
+            if roots:
+                units += [(drivepath, mountpoint, [root]) for root in roots]
+            else:
+                units.append((drivepath, mountpoint, None))
 
-            except Exception as exc:
-                self.logger.debug("Cannot scan %s | %s : %s", drivepath, mountpoint, exc)
+        pool_workers = pool_size(self.config.get('YARA_POOL_WORKERS'))
+        if pool_workers:
+            # Threads mostly wait for the yara processes, keep them all busy
+            self.config['PROCESS_WORKERS'] = max(int(self.config.get('PROCESS_WORKERS', 1)), 2 * pool_workers)
+        throttle = Throttle(self.config, pool_workers)
+
+        self.pipeline = ScanPipeline(self.scanners, self.config, self.logger, self.__collect, throttle,
+                                     on_checkpoint=self.__save_checkpoint,
+                                     resume=resume['units'] if resume else None,
+                                     is_replayed=self.__is_replayed,
+                                     metrics=self.metrics,
+                                     cache=cache)
+        if self.stop_requested:
+            self.pipeline.stop()
+        if not self.pipeline.run(units, lambda unit: self.__enumerate_unit(drivemanager, *unit)):
+            self.__save_checkpoint(self.pipeline.progress())
+            self.logger.info("IOCScan interrupted, progress saved to %s", self.checkpoint.path)
+            return 1
+
+        if (self.config.get('HASH_INDEX') or hash_iocs) and \
+                (self.indexer.records_changed() or not is_valid_hash_index()):
+            # Read by HashScanner.finalize
+            try:
+                with self.metrics.timer('hash_index_time'):
+                    save_hash_index(self.indexer.records())
+            except OSError as exc:
+                self.logger.error("Cannot write hash index: %s", exc)
 
         for scanner in self.scanners:
             state, report = scanner.finalize()
-            self.report += report
+            self.report.extend(report)
             self.state.update(state)
+        changes = None
+        if self.config.get('CHANGE_REPORT'):
+            with self.metrics.timer('index_diff_time'):
+                changes = self.indexer.diff()
+            if changes is not None:
+                self.state['changes'] = changes.summary()
+        with self.metrics.timer('index_write_time'):
+            self.indexer.write()
+        self.state['metrics'] = self.metrics.as_dict()
+        self.checkpoint.clear()
 
         self.__send_report()
+        if changes is not None:
+            self.__send_changes(changes)
         self.__send_state()
 
         self.logger.info("IOCScan done")
         return 0
 
+    def __open_index(self):
+        with self.metrics.timer('index_load_time'):
+            self.indexer = Indexer(max_deltas=int(self.config.get('INDEX_MAX_DELTAS', 8)),
+                                   compact_ratio=float(self.config.get('INDEX_COMPACT_RATIO', 0.1)),
+                                   codec=self.config.get('INDEX_CODEC', 'none'),
+                                   codec_level=self.config.get('INDEX_CODEC_LEVEL'))
+
+    def __init_scanners(self, scan_classes: list):
+        for scan_class in scan_classes:
+            scanner = scan_class(self.config, self.indexer, self.path_filter, self.metrics)
+            scanner.init()
+            self.scanners.append(scanner)
+
+    def __restore(self, resume: dict, scan_classes: list):
+        """Restore the progress of an interrupted scan, None if its checkpoint is unusable"""
+        ruleset = self.indexer.ruleset.hex() if self.indexer.ruleset is not None else None
+        if resume.get('index', dict()).get('ruleset') != ruleset:
+            # The files done before the checkpoint were matched with other rules
+            self.logger.info("Rules changed since checkpoint %s, starting over", self.checkpoint.path)
+            self.checkpoint.clear()
+            return None
+        try:
+            self.checkpoint.restore(resume, self.indexer)
+            for scanner in self.scanners:
+                scanner.restore_checkpoint(resume['scanners'].get(type(scanner).__name__, dict()))
+        except (JournalError, OSError, KeyError) as exc:
+            self.logger.error("Cannot restore checkpoint %s, starting over: %s", self.checkpoint.path, exc)
+            self.checkpoint.clear()
+            # The index and the scanners may be half restored
+            for scanner in self.scanners:
+                if isinstance(scanner, YaraScanner):
+                    scanner.close()
+            self.scanners = []
+            self.__open_index()
+            self.__init_scanners(scan_classes)
+            return None
+        return resume
+
+    def __collect(self, detections):
+        self.report.extend(serialize_batch(detections,
+                                           extra=self.config.get("task_id", None),
+                                           timestamp=self.config.get('timestamp')))
+
+    def __save_checkpoint(self, units: dict):
+        self.report.flush()
+        self.checkpoint.save(dict(
+            timestamp=self.config['timestamp'],
+            units=units,
+            scanners={type(scanner).__name__: scanner.save_checkpoint() for scanner in self.scanners}
+        ), self.indexer)
+
+    def __is_replayed(self, mountpoint, fobj) -> bool:
+        """True if a file done before the checkpoint is already restored in the index"""
+        if not self.path_filter.can_scan(fobj):
+            return True
+        return all(self.indexer.seen(stream_record(mountpoint, fobj, ads, stream))
+                   for ads, stream in fobj.streams.items())
+
+    def __enumerate_unit(self, drivemanager, drivepath, mountpoint, roots):
+        self.logger.info("Scanning %s | %s (%s)", drivepath, mountpoint, roots or 'all')
+        drive = drivemanager.open(drivepath, mountpoint)
+        for fobj in drive.enumerate_files(directory=roots,
+                                          recurse_callback=self.path_filter.scan_directory):
+            yield mountpoint, fobj
+
     def __send_report(self):
         report_mode = 'report_{}'.format(self.config.get('REPORTING_MODE', 'standard'))
-        if not DataClient().send(report_mode, 'iocscan_report', self.report):
-            self.logger.error("Could not send IOCScan report")
+
+        def send_batch(batch):
+            if not DataClient().send(report_mode, 'iocscan_report', batch):
+                return False
+            DataClient().flush(report_mode)
+            return True
+
+        if not self.report.send(send_batch):
+            self.logger.error("Could not send IOCScan report, kept in %s", self.report.path)
+
+    def __send_changes(self, changes):
+        report_mode = 'report_{}'.format(self.config.get('REPORTING_MODE', 'standard'))
+        report = changes.as_report(int(self.config.get('CHANGE_REPORT_MAX', 10000)))
+        report.update(extra=self.config.get("task_id", None), timestamp=self.config.get('timestamp'))
+        if not DataClient().send(report_mode, 'iocscan_changes', report):
+            self.logger.error("Could not send IOCScan change report")
         DataClient().flush(report_mode)
 
     def __send_state(self):
@@ -141,6 +421,9 @@ class IocScanApp(App):
 
     def _stop(self):
         self.logger.info("IOCScan STOP")
+        self.stop_requested = True
+        if self.pipeline:
+            self.pipeline.stop()
 
 
 def app_factory(platform=None):
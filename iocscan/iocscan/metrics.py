@@ -0,0 +1,101 @@
+"""
+metrics.py : Scan instrumentation
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Histogram(object):
+    """Power of two buckets of durations, in microseconds"""
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = dict()
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        bucket = int(seconds * 1000000).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def as_dict(self) -> dict:
+        return dict(
+            count=self.count,
+            total=self.total,
+            min=self.min,
+            max=self.max,
+            mean=self.total / self.count if self.count else None,
+            # [upper bound in microseconds, count]
+            buckets=[[1 << bucket, self.buckets[bucket]] for bucket in sorted(self.buckets)]
+        )
+
+
+class ScanMetrics(object):
+    """Counters and timing histograms shared by every scan stage"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+        self.rules = dict()
+
+    def count(self, name: str, value: int = 1):
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        with self.__lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def rule_cost(self, rule: str, seconds: float):
+        """Account the matching time of a file to a rule that fired on it"""
+        with self.__lock:
+            hits, total = self.rules.get(rule, (0, 0.0))
+            self.rules[rule] = (hits + 1, total + seconds)
+
+    def as_dict(self) -> dict:
+        with self.__lock:
+            out = dict(
+                counters=dict(self.counters),
+                timings={name: histogram.as_dict() for name, histogram in self.histograms.items()},
+                rules={rule: dict(hits=hits, time=total) for rule, (hits, total) in self.rules.items()}
+            )
+        lookups = out['counters'].get('index_hits', 0) + out['counters'].get('index_misses', 0)
+        if lookups:
+            out['index_hit_rate'] = out['counters'].get('index_hits', 0) / lookups
+        return out
@@ -0,0 +1,153 @@
+"""
+path_filter.py : Compiled scan exclusions
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import re
+from pathlib import Path
+
+from .metrics import ScanMetrics
+
+GLOB_CHARS = frozenset('*?[')
+
+
+def is_glob(pattern: str) -> bool:
+    return not GLOB_CHARS.isdisjoint(pattern)
+
+
+def trie_pattern(words, prefix: bool = True) -> str:
+    """Regex source matching any of the words (or prefixes), factored as a trie"""
+    trie = dict()
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, dict())
+        node[''] = None
+
+    def build(node):
+        is_end = '' in node
+        if is_end and prefix:
+            # A shorter prefix already matches everything below
+            return ''
+        alternatives = [re.escape(char) + build(node[char]) for char in sorted(node) if char]
+        if not alternatives:
+            return ''
+        if len(alternatives) == 1 and not is_end:
+            return alternatives[0]
+        return '(?:{}){}'.format('|'.join(alternatives), '?' if is_end else '')
+
+    return build(trie)
+
+
+def glob_pattern(glob: str) -> str:
+    """Regex source for a fnmatch-style glob ('*' also matches '/'), sets are parsed like fnmatch.translate"""
+    out = []
+    pos, end = 0, len(glob)
+    while pos < end:
+        char = glob[pos]
+        pos += 1
+        if char == '*':
+            out.append('.*')
+        elif char == '?':
+            out.append('.')
+        elif char == '[':
+            close = pos + 1 if glob[pos:pos + 1] == '!' else pos
+            if glob[close:close + 1] == ']':
+                # A leading ']' is part of the set
+                close += 1
+            close = glob.find(']', close)
+            if close < 0:
+                out.append(re.escape(char))
+                continue
+            chars = re.sub(r'([\\&~|\[])', r'\\\1', glob[pos:close])
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            elif chars.startswith('^'):
+                chars = '\\' + chars
+            out.append('[{}]'.format(chars))
+            pos = close + 1
+        else:
+            out.append(re.escape(char))
+    return ''.join(out)
+
+
+def compile_matcher(patterns, prefix: bool):
+    """Single compiled regex for literal entries (prefix or exact match) and globs, invalid globs are ignored"""
+    patterns = [item for item in patterns if item]
+    literals = [item for item in patterns if not is_glob(item)]
+    sources = []
+    for item in patterns:
+        if not is_glob(item):
+            continue
+        source = '{}\\Z'.format(glob_pattern(item))
+        try:
+            re.compile(source, re.DOTALL)
+        except re.error as exc:
+            logging.warning("Ignoring invalid pattern %r: %s", item, exc)
+            continue
+        sources.append(source)
+    if literals:
+        sources.insert(0, trie_pattern(literals, prefix) + ('' if prefix else '\\Z'))
+    if not sources:
+        return None
+    return re.compile('|'.join(sources), re.DOTALL)
+
+
+class PathFilter(object):
+    """Exclusions compiled once per scan and shared by the app and the scanners"""
+
+    def __init__(self, config: dict, strip_drive: bool = False, metrics: ScanMetrics = None):
+        self.strip_drive = strip_drive
+        self.metrics = metrics or ScanMetrics()
+        self.include_deleted = bool(config.get('INCLUDE_DELETED'))
+        self.extensions = frozenset(ext.lower() for ext in config.get('SCAN_EXTENSIONS') or [])
+        exclude_files = config.get('EXCLUDE_FILES') or []
+        self.exclude_names = frozenset(name for name in exclude_files if not is_glob(name))
+        self.exclude_names_re = compile_matcher([name for name in exclude_files if is_glob(name)], prefix=False)
+        self.exclude_dirs_re = compile_matcher(config.get('EXCLUDE_DIRS') or [], prefix=True)
+
+    def relative_path(self, item: Path) -> str:
+        """Posix path matched against the directory patterns, without the drive"""
+        path = item.as_posix()
+        if self.strip_drive and path[1:2] == ':':
+            path = path[3:]
+        return path
+
+    def scan_directory(self, item: Path) -> bool:
+        """Recursion callback: False if the directory is excluded"""
+        if self.exclude_dirs_re is None:
+            return True
+        if self.exclude_dirs_re.match(self.relative_path(item)) is None:
+            return True
+        self.metrics.count('dirs_excluded')
+        return False
+
+    def can_scan(self, item) -> bool:
+        if item.is_directory():
+            return False
+        if self.include_deleted and item.is_deleted():
+            return False
+        if self.extensions and item.path.suffix.lower() not in self.extensions:
+            return False
+        name = item.path.name
+        if name in self.exclude_names:
+            return False
+        if self.exclude_names_re is not None and self.exclude_names_re.match(name):
+            return False
+        return True
@@ -0,0 +1,206 @@
+"""
+pipeline.py : Staged scan pipeline
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import queue
+import threading
+import time
+from typing import Callable, Iterable
+
+from .checkpoint import UnitProgress
+from .content_cache import ContentCache
+from .metrics import ScanMetrics
+from .stream_pass import StreamPass
+from .throttle import Throttle
+
+
+class ScanPipeline(object):
+    """Enumerate -> process -> collect pipeline
+
+    Enumeration workers push (mountpoint, fobj) items in a bounded queue so
+    the directory walk never runs too far ahead of hashing and yara matching.
+    Process workers feed every item to the scanners and hand their detections
+    to a single collector, which is the only caller of report_sink.
+
+    Every CHECKPOINT_INTERVAL seconds the process workers are paused and
+    on_checkpoint is called with the progress of each unit. When resuming,
+    completed units are skipped and items already done are only processed
+    again if is_replayed(mountpoint, fobj) says they were not recorded.
+    """
+    _DONE = object()
+
+    def __init__(self, scanners: list, config: dict, logger, report_sink: Callable, throttle: Throttle = None,
+                 on_checkpoint: Callable = None, resume: dict = None, is_replayed: Callable = None,
+                 metrics: ScanMetrics = None, cache: ContentCache = None):
+        self.scanners = scanners
+        self.report_sink = report_sink
+        self.throttle = throttle or Throttle(dict())
+        self.metrics = metrics or ScanMetrics()
+        self.cache = cache
+        self.on_checkpoint = on_checkpoint
+        self.is_replayed = is_replayed
+        self.config = config
+        self.logger = logger
+        self.enum_workers = max(1, int(config.get('SCAN_WORKERS', 1)))
+        self.process_workers = max(1, int(config.get('PROCESS_WORKERS', 1)))
+        self.checkpoint_interval = float(config.get('CHECKPOINT_INTERVAL', 0))
+        self.__items = queue.Queue(maxsize=max(1, int(config.get('QUEUE_DEPTH', 16))))
+        self.__results = queue.Queue()
+        self.__units = queue.Queue()
+        self.__resume = resume or dict()
+        self.__progress = dict()
+        self.__stop = threading.Event()
+        self.__pause = threading.Condition()
+        self.__paused = False
+        self.__active = 0
+
+    def run(self, units: Iterable, enumerate_unit: Callable) -> bool:
+        """Scan all units, detections are handed to report_sink
+
+        enumerate_unit(unit) must yield (mountpoint, fobj) tuples.
+        Returns False if the scan was stopped before the end.
+        """
+        for unit in units:
+            unit_id = str(unit)
+            self.__progress[unit_id] = UnitProgress(self.__resume.get(unit_id))
+            self.__units.put((unit_id, unit))
+
+        enumerators = [threading.Thread(target=self.__enumerate, args=(enumerate_unit,), daemon=True)
+                       for _ in range(self.enum_workers)]
+        processors = [threading.Thread(target=self.__process, daemon=True)
+                      for _ in range(self.process_workers)]
+        collector = threading.Thread(target=self.__collect, daemon=True)
+
+        for thread in enumerators + processors + [collector]:
+            thread.start()
+
+        next_checkpoint = time.monotonic() + self.checkpoint_interval
+        for thread in enumerators:
+            while thread.is_alive():
+                thread.join(1.0)
+                if self.on_checkpoint and self.checkpoint_interval and time.monotonic() >= next_checkpoint:
+                    self.__checkpoint()
+                    next_checkpoint = time.monotonic() + self.checkpoint_interval
+        for _ in processors:
+            self.__items.put(self._DONE)
+        for thread in processors:
+            thread.join()
+        self.__results.put(self._DONE)
+        collector.join()
+        return not self.__stop.is_set()
+
+    def stop(self):
+        """Interrupt the scan, items still queued are left for the next run"""
+        self.__stop.set()
+
+    def progress(self) -> dict:
+        return {unit_id: progress.state() for unit_id, progress in self.__progress.items()}
+
+    def __checkpoint(self):
+        with self.__pause:
+            self.__paused = True
+            while self.__active:
+                self.__pause.wait()
+        try:
+            self.__results.join()
+            self.on_checkpoint(self.progress())
+        except Exception as exc:
+            self.logger.error("Cannot save checkpoint: %s", exc)
+        finally:
+            with self.__pause:
+                self.__paused = False
+                self.__pause.notify_all()
+
+    def __enumerate(self, enumerate_unit):
+        self.throttle.worker_started()
+        while not self.__stop.is_set():
+            try:
+                unit_id, unit = self.__units.get_nowait()
+            except queue.Empty:
+                return
+            progress = self.__progress[unit_id]
+            if progress.complete:
+                continue
+            start = time.perf_counter()
+            blocked = 0.0
+            try:
+                for seq, (mountpoint, fobj) in enumerate(enumerate_unit(unit)):
+                    if self.__stop.is_set():
+                        return
+                    progress.next_seq = seq + 1
+                    self.metrics.count('files_enumerated')
+                    if progress.is_done(seq) and (self.is_replayed is None or self.is_replayed(mountpoint, fobj)):
+                        self.metrics.count('files_resumed')
+                        continue
+                    put_start = time.perf_counter()
+                    self.__items.put((progress, seq, mountpoint, fobj))
+                    blocked += time.perf_counter() - put_start
+            except Exception as exc:
+                self.logger.debug("Cannot scan %s : %s", unit, exc)
+                self.metrics.count('units_failed')
+            progress.enumerated = True
+            # Time spent walking the unit, not waiting for the process workers
+            self.metrics.observe('enumeration_time', time.perf_counter() - start - blocked)
+
+    def __process(self):
+        self.throttle.worker_started()
+        while True:
+            item = self.__items.get()
+            if item is self._DONE:
+                return
+            if self.__stop.is_set():
+                # Drain the queue without processing so enumerators can exit
+                continue
+            progress, seq, mountpoint, fobj = item
+            with self.__pause:
+                while self.__paused:
+                    self.__pause.wait()
+                self.__active += 1
+            try:
+                self.__process_item(mountpoint, fobj)
+            finally:
+                progress.mark_done(seq)
+                with self.__pause:
+                    self.__active -= 1
+                    self.__pause.notify_all()
+
+    def __process_item(self, mountpoint, fobj):
+        # Every scanner reads the file through the same pass
+        stream_pass = StreamPass(fobj, self.config, self.throttle, self.metrics, self.cache)
+        for scanner in self.scanners:
+            try:
+                with self.metrics.timer('{}_time'.format(type(scanner).__name__)):
+                    detections = scanner.process(mountpoint, fobj, stream_pass)
+            except Exception as exc:
+                self.logger.debug("%s failed on %s : %s", type(scanner).__name__, fobj.path, exc)
+                self.metrics.count('process_errors')
+                continue
+            if detections:
+                self.__results.put(detections)
+        stream_pass.release()
+
+    def __collect(self):
+        while True:
+            detections = self.__results.get()
+            try:
+                if detections is self._DONE:
+                    return
+                self.report_sink(detections)
+            finally:
+                self.__results.task_done()
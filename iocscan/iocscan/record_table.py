@@ -0,0 +1,158 @@
+"""
+record_table.py : Compact in-memory storage of index records
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from array import array
+
+KEY_SIZE = 20
+DIGEST_SIZES = (16, 20, 32)  # md5, sha1, sha256
+DIGESTS_SIZE = sum(DIGEST_SIZES)
+NO_VERDICT = 0xFFFFFFFF
+
+
+class StringPool(object):
+    """Interned strings referenced by a small integer id"""
+
+    def __init__(self):
+        self.__ids = dict()
+        self.values = []
+
+    def add(self, value: str) -> int:
+        ident = self.__ids.get(value)
+        if ident is None:
+            ident = self.__ids[value] = len(self.values)
+            self.values.append(value)
+        return ident
+
+    def __getitem__(self, ident: int) -> str:
+        return self.values[ident]
+
+
+class RecordTable(object):
+    """Index records stored column-wise, one row per key
+
+    A row exists as soon as anything is known about its key (a verdict can
+    be set before the stream is indexed), is_indexed tells whether the
+    record fields were set.
+    """
+
+    MIN_SLOTS = 1024
+
+    def __init__(self):
+        # Open addressing table of row + 1, 0 for an empty slot
+        self.__slots = array('I', bytes(4 * self.MIN_SLOTS))
+        self.__strings = StringPool()
+        self.keys = bytearray()
+        self.indexed = bytearray()
+        self.mountpoints = array('I')
+        self.ads = array('I')
+        self.paths = bytearray()
+        self.path_offsets = array('Q')
+        self.path_sizes = array('I')
+        self.digests = bytearray()
+        self.entropy = array('f')
+        self.verdicts = array('I')
+
+    def __len__(self):
+        return len(self.indexed)
+
+    def __lookup(self, key: bytes, slots: array = None):
+        """(slot, row) of key, row is -1 and slot is free if missing"""
+        slots = slots if slots is not None else self.__slots
+        keys = self.keys
+        mask = len(slots) - 1
+        slot = hash(key) & mask
+        while True:
+            row = slots[slot] - 1
+            if row < 0 or keys[row * KEY_SIZE:(row + 1) * KEY_SIZE] == key:
+                return slot, row
+            slot = (slot + 1) & mask
+
+    def __grow(self):
+        # Filled before being swapped in, lookups may run concurrently
+        slots = array('I', bytes(8 * len(self.__slots)))
+        for row in range(len(self.indexed)):
+            slot, _ = self.__lookup(self.key(row), slots)
+            slots[slot] = row + 1
+        self.__slots = slots
+
+    def find(self, key: bytes) -> int:
+        return self.__lookup(key)[1]
+
+    def row(self, key: bytes) -> int:
+        """Row of key, created empty if missing"""
+        slot, row = self.__lookup(key)
+        if row < 0:
+            row = len(self.indexed)
+            self.__slots[slot] = row + 1
+            self.keys += key
+            self.indexed.append(0)
+            self.mountpoints.append(0)
+            self.ads.append(0)
+            self.path_offsets.append(0)
+            self.path_sizes.append(0)
+            self.digests += bytes(DIGESTS_SIZE)
+            self.entropy.append(0.0)
+            self.verdicts.append(NO_VERDICT)
+            if 2 * len(self.indexed) > len(self.__slots):
+                self.__grow()
+        return row
+
+    def key(self, row: int) -> bytes:
+        return bytes(self.keys[row * KEY_SIZE:(row + 1) * KEY_SIZE])
+
+    def is_indexed(self, row: int) -> bool:
+        return row >= 0 and self.indexed[row] == 1
+
+    def set_fields(self, row: int, mountpoint: str, path: str, ads: str, md5: bytes, sha1: bytes, sha256: bytes,
+                   entropy: float):
+        path = path.encode('utf-8')
+        self.indexed[row] = 1
+        self.mountpoints[row] = self.__strings.add(mountpoint)
+        self.ads[row] = self.__strings.add(ads)
+        self.path_offsets[row] = len(self.paths)
+        self.path_sizes[row] = len(path)
+        self.paths += path
+        self.digests[row * DIGESTS_SIZE:(row + 1) * DIGESTS_SIZE] = md5 + sha1 + sha256
+        self.entropy[row] = entropy
+
+    def fields(self, row: int) -> tuple:
+        """(mountpoint, path, ads, md5, sha1, sha256, entropy), path as UTF-8 bytes"""
+        offset = self.path_offsets[row]
+        digests = bytes(self.digests[row * DIGESTS_SIZE:(row + 1) * DIGESTS_SIZE])
+        md5_size, sha1_size, _ = DIGEST_SIZES
+        return (self.__strings[self.mountpoints[row]], bytes(self.paths[offset:offset + self.path_sizes[row]]),
+                self.__strings[self.ads[row]], digests[:md5_size], digests[md5_size:md5_size + sha1_size],
+                digests[md5_size + sha1_size:], self.entropy[row])
+
+    def set_verdict(self, row: int, rules: list):
+        self.verdicts[row] = self.__strings.add('\n'.join(rules))
+
+    def verdict(self, row: int):
+        ident = self.verdicts[row]
+        if ident == NO_VERDICT:
+            return None
+        rules = self.__strings[ident]
+        return rules.split('\n') if rules else []
+
+    def sorted_rows(self) -> list:
+        """Indexed rows by increasing key"""
+        keys = self.keys
+        return sorted((row for row in range(len(self.indexed)) if self.indexed[row]),
+                      key=lambda row: keys[row * KEY_SIZE:(row + 1) * KEY_SIZE])
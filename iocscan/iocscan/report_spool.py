@@ -0,0 +1,190 @@
+"""
+report_spool.py : On-disk spool for scan reports
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import heapq
+import json
+import logging
+import os
+import tempfile
+import threading
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Callable, Iterator, List, Tuple
+
+
+class ReportSpool(object):
+    """Append-only JSON lines log of detections
+
+    At most buffer_size entries are kept in memory before being appended to
+    the log, and the log is sent back in batches of at most batch_size bytes
+    of serialized data. Whatever could not be sent stays in the spool and is
+    sent with the next run. An entry left incomplete by a crash during an
+    append is dropped when the spool is opened.
+
+    With a sort_key, the log is sorted before being sent: sorted runs of at
+    most sort_size bytes are merged from temporary files.
+    """
+
+    def __init__(self, path: Path, buffer_size: int = 1000, batch_size: int = 1024 * 1024,
+                 sort_key: Callable = None, sort_size: int = 16 * 1024 * 1024):
+        self.path = path
+        self.buffer_size = max(1, buffer_size)
+        self.batch_size = max(1, batch_size)
+        self.sort_key = sort_key
+        self.sort_size = max(1, sort_size)
+        self.count = 0
+        self.__buffer = []
+        self.__lock = threading.Lock()
+        self.__repair()
+
+    def __repair(self):
+        """Truncate the log after its last complete line"""
+        try:
+            ofile = self.path.open('r+b')
+        except FileNotFoundError:
+            return
+        with ofile:
+            end = ofile.seek(0, os.SEEK_END)
+            pos = end
+            while pos > 0:
+                start = max(0, pos - 64 * 1024)
+                ofile.seek(start)
+                newline = ofile.read(pos - start).rfind(b'\n')
+                if newline >= 0:
+                    pos = start + newline + 1
+                    break
+                pos = start
+            if pos < end:
+                logging.warning("Dropping %d bytes of incomplete report entries from %s", end - pos, self.path)
+                ofile.truncate(pos)
+
+    def extend(self, detections: List[dict]):
+        with self.__lock:
+            for detection in detections:
+                self.__buffer.append(json.dumps(detection, separators=(',', ':'), default=str))
+            self.count += len(detections)
+            if len(self.__buffer) >= self.buffer_size:
+                self.__write()
+
+    def flush(self):
+        with self.__lock:
+            self.__write()
+
+    def __write(self):
+        if not self.__buffer:
+            return
+        with self.path.open('a', encoding='utf-8') as ofile:
+            ofile.write('\n'.join(self.__buffer))
+            ofile.write('\n')
+        self.__buffer = []
+
+    def __entries(self, ifile):
+        """(line, detection) of each valid line of the log"""
+        for line in ifile:
+            try:
+                yield line, json.loads(line.decode('utf-8'))
+            except ValueError:
+                logging.warning("Skipping invalid report entry in %s: %r", self.path, line[:100])
+
+    def batches(self) -> Iterator[Tuple[List[dict], int]]:
+        """Yield (detections, offset of the next batch) from the log"""
+        if not self.path.exists():
+            return
+        with self.path.open('rb') as ifile:
+            batch, size = [], 0
+            for line, detection in self.__entries(ifile):
+                if batch and size + len(line) > self.batch_size:
+                    yield batch, ifile.tell() - len(line)
+                    batch, size = [], 0
+                batch.append(detection)
+                size += len(line)
+            if batch:
+                yield batch, ifile.tell()
+
+    def __spill(self, stack: ExitStack, run: list):
+        run.sort()
+        ofile = stack.enter_context(tempfile.TemporaryFile())
+        ofile.writelines(line for _, line in run)
+        ofile.seek(0)
+        return ofile
+
+    def __read_run(self, ifile):
+        for line, detection in self.__entries(ifile):
+            yield self.sort_key(detection), line
+
+    def __sort(self):
+        if not self.path.exists():
+            return
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with ExitStack() as stack:
+            runs = []
+            run, size = [], 0
+            with self.path.open('rb') as ifile:
+                for line, detection in self.__entries(ifile):
+                    run.append((self.sort_key(detection), line))
+                    size += len(line)
+                    if size >= self.sort_size:
+                        runs.append(self.__spill(stack, run))
+                        run, size = [], 0
+            if runs:
+                runs.append(self.__spill(stack, run))
+                merged = heapq.merge(*[self.__read_run(run_file) for run_file in runs])
+            else:
+                merged = sorted(run)
+            with tmp_path.open('wb') as ofile:
+                ofile.writelines(line for _, line in merged)
+        os.replace(str(tmp_path), str(self.path))
+
+    def send(self, callback: Callable[[List[dict]], bool]) -> bool:
+        """Send every batch through callback, keep the unsent ones on failure
+
+        An empty log is sent as one empty batch.
+        """
+        self.flush()
+        sent = 0
+        with self.__lock:
+            if self.sort_key is not None:
+                self.__sort()
+            empty = True
+            for batch, offset in self.batches():
+                empty = False
+                if not callback(batch):
+                    self.__truncate(sent)
+                    return False
+                sent = offset
+            if empty and not callback([]):
+                return False
+            if self.path.exists():
+                os.remove(str(self.path))
+        return True
+
+    def __truncate(self, offset: int):
+        """Drop the first offset bytes (already sent) of the log"""
+        if not offset:
+            return
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with self.path.open('rb') as ifile, tmp_path.open('wb') as ofile:
+            ifile.seek(offset)
+            while True:
+                chunk = ifile.read(1024 * 1024)
+                if not chunk:
+                    break
+                ofile.write(chunk)
+        os.replace(str(tmp_path), str(self.path))
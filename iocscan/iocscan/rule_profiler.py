@@ -0,0 +1,121 @@
+"""
+rule_profiler.py : Matching cost of the yara rules
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import heapq
+import threading
+
+from .metrics import Histogram
+
+
+def _cost(value):
+    """Cost of a rule in the yara profiling info, which layout depends on the yara version"""
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, dict):
+        for name in ('cost', 'time'):
+            if isinstance(value.get(name), (int, float)):
+                return value[name]
+    return None
+
+
+class RuleProfiler(object):
+    """Time spent per ruleset and per rule, timeouts and slowest files
+
+    Rulesets are timed with one sub-scan each. Rules are only ranked by
+    yara's own profiling info, when the library was built with it: the
+    matching time of the files a rule fired on says little about its cost.
+    """
+
+    def __init__(self, top: int = 20):
+        self.top = top
+        self.__lock = threading.Lock()
+        self.rulesets = dict()
+        self.timeouts = dict()
+        # min-heap of (seconds, path), the slowest files
+        self.__files = []
+
+    def ruleset_time(self, name: str, seconds: float):
+        with self.__lock:
+            histogram = self.rulesets.get(name)
+            if histogram is None:
+                histogram = self.rulesets[name] = Histogram()
+            histogram.add(seconds)
+
+    def timeout(self, name: str):
+        with self.__lock:
+            self.timeouts[name] = self.timeouts.get(name, 0) + 1
+
+    def file_time(self, path: str, seconds: float):
+        with self.__lock:
+            if len(self.__files) < self.top:
+                heapq.heappush(self.__files, (seconds, path))
+            elif seconds > self.__files[0][0]:
+                heapq.heapreplace(self.__files, (seconds, path))
+
+    def slow_files(self) -> list:
+        with self.__lock:
+            return [dict(path=path, time=seconds) for seconds, path in sorted(self.__files, reverse=True)]
+
+    def slow_rulesets(self) -> list:
+        with self.__lock:
+            items = [dict(ruleset=name, time=histogram.total, scans=histogram.count,
+                          mean=histogram.total / histogram.count, max=histogram.max,
+                          timeouts=self.timeouts.get(name, 0))
+                     for name, histogram in self.rulesets.items()]
+        return sorted(items, key=lambda item: item['time'], reverse=True)[:self.top]
+
+    def slow_rules(self, yara_rules: list) -> tuple:
+        """(ranked rules, ranked namespaces) by yara's profiling info, None without it"""
+        costs = dict()
+        for rules in yara_rules:
+            profiling_info = getattr(rules, 'profiling_info', None)
+            if profiling_info is None:
+                continue
+            try:
+                info = profiling_info()
+            except Exception:
+                continue
+            for rule, value in (info or dict()).items():
+                cost = _cost(value)
+                if cost is not None:
+                    costs[rule] = costs.get(rule, 0) + cost
+        if not costs:
+            return None
+        namespaces = dict()
+        for rule, cost in costs.items():
+            namespace = rule.split(':', 1)[0] if ':' in rule else 'default'
+            namespaces[namespace] = namespaces.get(namespace, 0) + cost
+        return ([dict(rule=rule, cost=cost)
+                 for rule, cost in sorted(costs.items(), key=lambda item: item[1], reverse=True)[:self.top]],
+                [dict(namespace=name, cost=cost)
+                 for name, cost in sorted(namespaces.items(), key=lambda item: item[1], reverse=True)[:self.top]])
+
+    def report(self, yara_rules: list) -> dict:
+        out = dict(
+            slow_rulesets=self.slow_rulesets(),
+            slow_files=self.slow_files(),
+            timeouts=sum(self.timeouts.values())
+        )
+        slow_rules = self.slow_rules(yara_rules)
+        if slow_rules is None:
+            out['rule_profile'] = 'missing, yara was built without profiling'
+        else:
+            out['slow_rules'], out['slow_namespaces'] = slow_rules
+        return out
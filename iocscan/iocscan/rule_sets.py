@@ -0,0 +1,116 @@
+"""
+rule_sets.py : Yara rulesets and the files they apply to
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+import json
+import threading
+from collections import namedtuple
+
+from .path_filter import compile_matcher
+
+# Rulesets applying to a file, their positions, compiled rules and the fingerprint of the combination
+RulesetGroup = namedtuple('RulesetGroup', ['rulesets', 'positions', 'rules', 'fingerprint'])
+
+
+class RuleScope(object):
+    """Files a ruleset applies to, every criterion left empty matches all files"""
+
+    def __init__(self, extensions: list = None, roots: list = None, min_size_kb: float = 0,
+                 max_size_mb: float = None):
+        self.extensions = frozenset(ext.lower() for ext in extensions or [])
+        self.roots = list(roots or [])
+        self.roots_re = compile_matcher(self.roots, prefix=True)
+        self.min_size = int(float(min_size_kb or 0) * 1024)
+        self.max_size = int(float(max_size_mb) * 1024 * 1024) if max_size_mb else None
+
+    @classmethod
+    def from_config(cls, config: dict):
+        return cls(config.get('extensions'), config.get('roots'), config.get('min_size_kb', 0),
+                   config.get('max_size_mb'))
+
+    def applies(self, path: str, suffix: str, size: int) -> bool:
+        """path is the posix path without its drive, suffix the file extension"""
+        if size < self.min_size or (self.max_size is not None and size >= self.max_size):
+            return False
+        if self.extensions and suffix.lower() not in self.extensions:
+            return False
+        return self.roots_re is None or self.roots_re.match(path) is not None
+
+    @property
+    def is_unbounded(self) -> bool:
+        return not self.extensions and self.roots_re is None and not self.min_size and self.max_size is None
+
+    def as_dict(self) -> dict:
+        return dict(extensions=sorted(self.extensions), roots=self.roots, min_size=self.min_size,
+                    max_size=self.max_size)
+
+
+class Ruleset(object):
+    """Compiled rules loaded from one blob"""
+
+    def __init__(self, name: str, rules, digest: bytes, scope: RuleScope = None):
+        self.name = name
+        self.rules = rules
+        self.digest = digest
+        self.scope = scope or RuleScope()
+
+
+class RulesetGroups(object):
+    """Rulesets applying to each file, grouped by the combination they form
+
+    The rules of a group are matched together against the same buffer. Each
+    group has its own fingerprint, so cached matches are only reused for
+    files scanned with the same rules.
+    """
+
+    def __init__(self, rulesets: list):
+        self.rulesets = rulesets
+        # Scopes are part of the fingerprint, changing them invalidates the stored verdicts
+        if len(rulesets) == 1 and rulesets[0].scope.is_unbounded:
+            # Same as a single RULES_FILE, the verdicts stored with it stay valid
+            self.fingerprint = rulesets[0].digest
+        else:
+            self.fingerprint = hashlib.sha256(b''.join(
+                ruleset.digest + json.dumps(ruleset.scope.as_dict(), sort_keys=True).encode('utf-8')
+                for ruleset in rulesets)).digest()
+        self.__lock = threading.Lock()
+        # tuple of ruleset positions -> RulesetGroup
+        self.__groups = dict()
+
+    def __len__(self):
+        return len(self.rulesets)
+
+    @property
+    def names(self) -> list:
+        return [ruleset.name for ruleset in self.rulesets]
+
+    def select(self, path: str, suffix: str, size: int):
+        """RulesetGroup applying to a file, None if no ruleset does"""
+        members = tuple(pos for pos, ruleset in enumerate(self.rulesets) if ruleset.scope.applies(path, suffix, size))
+        if not members:
+            return None
+        group = self.__groups.get(members)
+        if group is None:
+            rulesets = [self.rulesets[pos] for pos in members]
+            group = RulesetGroup(rulesets, members, [ruleset.rules for ruleset in rulesets],
+                                 hashlib.sha256(b''.join(ruleset.digest for ruleset in rulesets)).digest())
+            with self.__lock:
+                self.__groups[members] = group
+        return group
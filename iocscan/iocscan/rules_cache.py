@@ -0,0 +1,131 @@
+"""
+rules_cache.py : Local cache of the compiled yara rules
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Callable
+
+CACHE_VERSION = 1
+
+
+def file_digest(path: Path) -> bytes:
+    digest = hashlib.sha256()
+    with path.open('rb') as ifile:
+        for chunk in iter(lambda: ifile.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+class RulesCache(object):
+    """Compiled rules blobs stored by sha256, with the time they were last fetched
+
+    A blob fetched less than ttl seconds ago is used without contacting the
+    server. Past that it is fetched again, the file is only rewritten if its
+    digest changed. The cached blob is used as long as the server cannot be
+    reached.
+    """
+
+    def __init__(self, directory: Path = Path('iocscan.rules'), ttl: float = 7 * 24 * 3600):
+        self.directory = directory
+        self.ttl = ttl
+        self.__meta_path = directory / 'cache.json'
+
+    def __load_meta(self) -> dict:
+        try:
+            with self.__meta_path.open('r', encoding='utf-8') as ifile:
+                meta = json.load(ifile)
+        except (OSError, ValueError):
+            return dict()
+        return meta.get('blobs', dict()) if meta.get('version') == CACHE_VERSION else dict()
+
+    def __save_meta(self, blobs: dict):
+        tmp_path = self.__meta_path.with_name(self.__meta_path.name + '.tmp')
+        with tmp_path.open('w', encoding='utf-8') as ofile:
+            json.dump(dict(version=CACHE_VERSION, blobs=blobs), ofile)
+        os.replace(str(tmp_path), str(self.__meta_path))
+
+    def blob_path(self, digest: bytes) -> Path:
+        return self.directory / '{}.yarc'.format(digest.hex())
+
+    def __cached(self, entry: dict):
+        """(path, digest) of a cache entry if its file is intact"""
+        if not entry:
+            return None
+        digest = bytes.fromhex(entry['digest'])
+        path = self.blob_path(digest)
+        try:
+            if file_digest(path) == digest:
+                return path, digest
+        except OSError:
+            pass
+        logging.warning("Cached rules %s are missing or corrupt", path)
+        return None
+
+    def get(self, name: str, fetch: Callable):
+        """(path, sha256) of the compiled rules blob name, None if unavailable
+
+        fetch() returns the blob, or None if it cannot be downloaded.
+        """
+        blobs = self.__load_meta()
+        entry = blobs.get(name)
+        cached = self.__cached(entry)
+        if cached is not None and time.time() - entry['fetched'] < self.ttl:
+            return cached
+
+        data = fetch()
+        if not data:
+            if cached is not None:
+                logging.warning("Cannot fetch rules %s, using the cached copy", name)
+            return cached
+
+        digest = hashlib.sha256(data).digest()
+        path = self.blob_path(digest)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if cached is None or cached[1] != digest:
+            tmp_path = path.with_name(path.name + '.tmp')
+            with tmp_path.open('wb') as ofile:
+                ofile.write(data)
+            os.replace(str(tmp_path), str(path))
+        blobs[name] = dict(digest=digest.hex(), fetched=time.time())
+        self.__save_meta(blobs)
+        self.__prune(blobs)
+        return path, digest
+
+    def invalidate(self, name: str):
+        """Forget a blob that could not be loaded"""
+        blobs = self.__load_meta()
+        entry = blobs.pop(name, None)
+        if entry is None:
+            return
+        self.__save_meta(blobs)
+        self.__prune(blobs)
+
+    def __prune(self, blobs: dict):
+        used = set(self.blob_path(bytes.fromhex(entry['digest'])) for entry in blobs.values())
+        for path in self.directory.glob('*.yarc'):
+            if path not in used:
+                try:
+                    os.remove(str(path))
+                except OSError:
+                    pass
@@ -0,0 +1,348 @@
+"""
+stream_pass.py : Single read pass shared by the scanners
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+import math
+import time
+from collections import Counter
+from typing import Callable
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .content_cache import FINGERPRINT_BLOCK, ContentCache, content_fingerprint
+from .metrics import ScanMetrics
+from .throttle import Throttle
+
+HASH_NAMES = ('md5', 'sha1', 'sha256')
+CHUNK_SIZE = 1024 * 1024
+
+
+def compute_entropy(histogram, size: int) -> float:
+    """Shannon entropy (bits per byte) of a byte histogram"""
+    if not size:
+        return 0.0
+    entropy = 0.0
+    for count in histogram:
+        if count:
+            freq = int(count) / size
+            entropy -= freq * math.log2(freq)
+    return entropy
+
+
+def _match(rules, data: bytes, fast: bool, deadline: float = None) -> list:
+    if deadline is None:
+        return rules.match(data=data, fast=fast)
+    # yara takes whole seconds, a spent budget still gets the shortest timeout
+    return rules.match(data=data, fast=fast, timeout=max(1, int(math.ceil(deadline - time.monotonic()))))
+
+
+class StreamDigest(object):
+    """Digests and entropy of one stream"""
+    __slots__ = ('hashes', 'histogram', 'size')
+
+    def __init__(self):
+        self.hashes = {name: hashlib.new(name) for name in HASH_NAMES}
+        self.histogram = numpy.zeros(256, dtype=numpy.int64) if numpy is not None else [0] * 256
+        self.size = 0
+
+    def update(self, data: bytes):
+        for hash_obj in self.hashes.values():
+            hash_obj.update(data)
+        if numpy is not None:
+            self.histogram += numpy.bincount(numpy.frombuffer(data, dtype=numpy.uint8), minlength=256)
+        else:
+            histogram = self.histogram
+            for value, count in Counter(data).items():
+                histogram[value] += count
+        self.size += len(data)
+
+    @property
+    def entropy(self) -> float:
+        return compute_entropy(self.histogram, self.size)
+
+    def as_dict(self) -> dict:
+        """Same layout as fobj.get_hashes()"""
+        out = dict(self.hashes)
+        out['entropy'] = self.entropy
+        return out
+
+
+class StreamPass(object):
+    """Read each stream of a file object at most once
+
+    The first consumer of a stream triggers the read. Streams up to
+    SHARED_READ_MAX MB are kept in memory for the lifetime of the pass so
+    yara, the hashes and the entropy are all computed from the same buffer;
+    bigger streams are hashed on the fly while being read.
+    Without a raw stream accessor on the file object, every call falls back
+    to the matching fobj getter, whose hashes and entropy are kept per stream.
+    Reads and CPU heavy work all go through the scan throttle and are
+    accounted in the scan metrics.
+    With a content cache, digests and yara matches of a stream whose first
+    and last blocks were already seen are reused without reading it.
+    """
+
+    def __init__(self, fobj, config: dict, throttle: Throttle = None, metrics: ScanMetrics = None,
+                 cache: ContentCache = None):
+        self.fobj = fobj
+        self.throttle = throttle or Throttle(dict())
+        self.metrics = metrics or ScanMetrics()
+        self.cache = cache
+        self.__max_buffer = config.get('SHARED_READ_MAX', 64) * 1024 * 1024
+        self.__data = dict()
+        self.__digests = dict()
+        self.__fingerprints = dict()
+        # Results of the fobj getters, when there is no raw stream accessor
+        self.__fobj_hashes = dict()
+        self.__fobj_entropy = dict()
+
+    @property
+    def can_read(self) -> bool:
+        return callable(getattr(self.fobj, 'open', None))
+
+    def __chunks(self, ads):
+        with self.fobj.open(ads) as stream:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                self.throttle.read(len(chunk))
+                self.metrics.count('bytes_read', len(chunk))
+                yield chunk
+
+    def __get_data(self, ads):
+        if ads in self.__data:
+            return self.__data[ads]
+        data = None
+        if self.can_read and self.fobj.streams[ads]['size'] <= self.__max_buffer:
+            with self.metrics.timer('read_time'):
+                data = b''.join(self.__chunks(ads))
+        self.__data[ads] = data
+        return data
+
+    def __account_read(self, ads):
+        """Reads done by the fobj helpers themselves"""
+        size = self.fobj.streams[ads]['size']
+        self.throttle.read(size)
+        self.metrics.count('bytes_read', size)
+
+    def __read_fingerprint(self, ads, size: int) -> bytes:
+        data = self.__data.get(ads)
+        if data is not None:
+            head = data[:FINGERPRINT_BLOCK]
+            tail = data[-FINGERPRINT_BLOCK:] if size > 2 * FINGERPRINT_BLOCK else data[FINGERPRINT_BLOCK:]
+            return content_fingerprint(size, head, tail)
+        with self.fobj.open(ads) as stream:
+            if size <= 2 * FINGERPRINT_BLOCK:
+                head, tail = stream.read(size), b''
+                if size <= self.__max_buffer:
+                    # Whole stream read, keep it for the other consumers
+                    self.__data[ads] = head
+            else:
+                head = stream.read(FINGERPRINT_BLOCK)
+                stream.seek(size - FINGERPRINT_BLOCK)
+                tail = stream.read(FINGERPRINT_BLOCK)
+        self.throttle.read(len(head) + len(tail))
+        self.metrics.count('bytes_read', len(head) + len(tail))
+        return content_fingerprint(size, head, tail)
+
+    def __fingerprint(self, ads):
+        """Content cache key of a stream, None without a cache or a raw accessor"""
+        if self.cache is None or not self.can_read:
+            return None
+        if ads not in self.__fingerprints:
+            try:
+                self.__fingerprints[ads] = self.__read_fingerprint(ads, self.fobj.streams[ads]['size'])
+            except (OSError, ValueError):
+                self.__fingerprints[ads] = None
+        return self.__fingerprints[ads]
+
+    def __get_digest(self, ads):
+        digest = self.__digests.get(ads)
+        if digest is None:
+            fingerprint = self.__fingerprint(ads)
+            if fingerprint is not None:
+                digest = self.cache.get_digest(fingerprint)
+                if digest is not None:
+                    self.metrics.count('dedup_hash_hits')
+            if digest is None:
+                digest = StreamDigest()
+                data = self.__get_data(ads)
+                with self.metrics.timer('hash_time'):
+                    for chunk in [data] if data is not None else self.__chunks(ads):
+                        with self.throttle.cpu():
+                            digest.update(chunk)
+                if fingerprint is not None:
+                    self.cache.put_digest(fingerprint, digest)
+            self.__digests[ads] = digest
+        return digest
+
+    def scan_yara(self, rules: list, ads, fast: bool, ruleset: bytes = None, deadline: float = None,
+                  matcher: Callable = None) -> list:
+        """Matches of rules, ruleset identifies them in the content cache
+
+        With a deadline (time.monotonic() value), yara raises its TimeoutError
+        once it is reached. Streams too large to be kept are read again for
+        the match, regular files without a raw accessor are read by path. Only
+        the streams left to the fobj helper (deleted files and alternate
+        streams without a raw accessor) have no timeout.
+        matcher() can match the stream out of this pass, it returns
+        (matches, bytes read) or None to fall back to matching it here.
+        """
+        fingerprint = self.__fingerprint(ads) if ruleset is not None else None
+        if fingerprint is not None:
+            matches = self.cache.get_matches(fingerprint, ruleset)
+            if matches is not None:
+                self.metrics.count('dedup_yara_hits')
+                return list(matches)
+        matches = self.__delegate(matcher) if matcher is not None else None
+        if matches is None:
+            matches = self.__scan_yara(rules, ads, fast, deadline)
+        if fingerprint is not None:
+            self.cache.put_matches(fingerprint, ruleset, matches)
+        return matches
+
+    def __delegate(self, matcher: Callable):
+        # The worker processes are throttled through the threads waiting for them
+        with self.metrics.timer('yara_time'), self.throttle.cpu():
+            result = matcher()
+        if result is None:
+            return None
+        matches, size = result
+        self.throttle.read(size)
+        self.metrics.count('bytes_read', size)
+        return matches
+
+    def __read_once(self, ads):
+        """Whole stream for a single consumer, None if only the fobj helper can read it"""
+        if self.can_read:
+            with self.metrics.timer('read_time'):
+                return b''.join(self.__chunks(ads))
+        if (ads and ads != '$Data') or self.fobj.is_deleted():
+            return None
+        try:
+            with self.metrics.timer('read_time'), open(str(self.fobj.path), 'rb') as ifile:
+                data = ifile.read()
+        except OSError:
+            return None
+        self.throttle.read(len(data))
+        self.metrics.count('bytes_read', len(data))
+        return data
+
+    def __scan_yara(self, rules: list, ads, fast: bool, deadline: float = None) -> list:
+        data = self.__get_data(ads)
+        if data is None:
+            # Not kept for the other consumers, but matched here so the deadline applies
+            data = self.__read_once(ads)
+        if data is None:
+            self.__account_read(ads)
+            with self.metrics.timer('yara_time'), self.throttle.cpu():
+                matches = self.fobj.scan_yara(rules, ads, fast)
+            if deadline is not None and time.monotonic() > deadline:
+                self.metrics.count('yara_untimed_overruns')
+            return matches
+        matches = []
+        with self.metrics.timer('yara_time'), self.throttle.cpu():
+            for rule in rules:
+                matches += _match(rule, data, fast, deadline)
+        return matches
+
+    def scan_yara_windows(self, rules: list, ads, fast: bool, window: int, overlap: int, edge: int,
+                          deadline: float = None):
+        """(matches, complete) of a stream too large to be matched whole
+
+        The first and last edge bytes are always matched, then overlapping
+        windows in between until the deadline. Offsets and filesize seen by
+        the rules are relative to each window. Needs a raw stream accessor.
+        """
+        size = self.fobj.streams[ads]['size']
+        ranges = [(0, min(edge, size))]
+        if size > edge:
+            ranges.append((max(edge, size - edge), size))
+        step = max(1, window - overlap)
+        ranges += [(start, min(size - edge + overlap, start + window))
+                   for start in range(max(0, edge - overlap), size - edge, step)]
+        matches = dict()
+        complete = True
+        with self.fobj.open(ads) as stream:
+            for pos, (start, end) in enumerate(ranges):
+                if pos >= 2 and deadline is not None and time.monotonic() >= deadline:
+                    complete = False
+                    break
+                with self.metrics.timer('read_time'):
+                    stream.seek(start)
+                    data = stream.read(end - start)
+                self.throttle.read(len(data))
+                self.metrics.count('bytes_read', len(data))
+                with self.metrics.timer('yara_time'), self.throttle.cpu():
+                    try:
+                        for rule in rules:
+                            for match in _match(rule, data, fast, deadline):
+                                matches.setdefault((match.namespace, match.rule), match)
+                    except Exception:
+                        if deadline is None or time.monotonic() < deadline:
+                            raise
+                        # Timed out, keep what the previous windows found
+                        complete = False
+                        break
+        self.metrics.count('yara_windows', pos + 1 if complete else pos)
+        return list(matches.values()), complete
+
+    def get_hashes(self, ads) -> dict:
+        if not self.can_read:
+            hashes = self.__fobj_hashes.get(ads)
+            if hashes is None:
+                self.__account_read(ads)
+                with self.metrics.timer('hash_time'), self.throttle.cpu():
+                    hashes = self.__fobj_hashes[ads] = self.fobj.get_hashes(ads)
+            return hashes
+        return self.__get_digest(ads).as_dict()
+
+    def get_hexdigest(self, hash_name: str, ads) -> str:
+        if not self.can_read:
+            hashes = self.__fobj_hashes.get(ads)
+            if hashes is not None and hashes.get(hash_name) is not None:
+                return hashes[hash_name].hexdigest()
+            return getattr(self.fobj, 'get_hash_{}'.format(hash_name))(ads)
+        return self.__get_digest(ads).hashes[hash_name].hexdigest()
+
+    def get_hexdigests(self, ads) -> dict:
+        """All hex digests plus entropy, computed in a single pass"""
+        hashes = self.get_hashes(ads)
+        out = {name: hashes[name].hexdigest() for name in HASH_NAMES if hashes.get(name) is not None}
+        out['entropy'] = hashes['entropy'] if 'entropy' in hashes else self.get_entropy(ads)
+        return out
+
+    def get_entropy(self, ads) -> float:
+        if not self.can_read:
+            hashes = self.__fobj_hashes.get(ads)
+            if hashes is not None and 'entropy' in hashes:
+                return hashes['entropy']
+            if ads not in self.__fobj_entropy:
+                self.__fobj_entropy[ads] = self.fobj.get_entropy(ads)
+            return self.__fobj_entropy[ads]
+        return self.__get_digest(ads).entropy
+
+    def release(self):
+        """Drop the buffered streams"""
+        self.__data.clear()
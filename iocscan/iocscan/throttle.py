@@ -0,0 +1,140 @@
+"""
+throttle.py : Resource throttling for the scan
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# ioprio_set syscall numbers per Linux architecture
+IOPRIO_SYSCALLS = dict(x86_64=251, amd64=251, i386=289, i686=289, aarch64=30, arm64=30, armv7l=314, armv8l=314)
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_SHIFT = 13
+
+
+def lower_priority(nice: int = 10, process: bool = False):
+    """Lower the CPU and I/O priority of the calling thread (both are per thread on Linux)
+
+    Elsewhere os.nice renices the whole process, it is only called there
+    when process is set, from a process doing nothing but scanning.
+    """
+    if hasattr(os, 'nice') and (process or sys.platform.startswith('linux')):
+        try:
+            os.nice(nice)
+        except OSError as exc:
+            logging.debug("Cannot lower CPU priority: %s", exc)
+    if sys.platform.startswith('linux'):
+        syscall_nr = IOPRIO_SYSCALLS.get(platform.machine().lower())
+        if syscall_nr is None:
+            return
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            # Lowest best-effort level, idle class could starve the scan forever
+            if libc.syscall(syscall_nr, IOPRIO_WHO_PROCESS, 0, (IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT) | 7) != 0:
+                logging.debug("Cannot lower I/O priority: errno %d", ctypes.get_errno())
+        except (OSError, AttributeError) as exc:
+            logging.debug("Cannot lower I/O priority: %s", exc)
+
+
+class TokenBucket(object):
+    """Cap a byte rate, consumers sleep until enough tokens are available"""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.__tokens = self.burst
+        self.__last = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def consume(self, amount: int, factor: float = 1.0):
+        rate = self.rate * factor
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * rate)
+            self.__last = now
+            self.__tokens -= amount
+            delay = -self.__tokens / rate if self.__tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class Throttle(object):
+    """Byte rate, CPU duty cycle and adaptive load-based throttling
+
+    THROTTLE_READ_MBPS caps the bytes read per second (0 disables it),
+    THROTTLE_CPU_PERCENT is the share of time each worker may spend hashing
+    or matching and THROTTLE_ADAPTIVE scales both down while the system load
+    per CPU, not counting the scan workers and the pool_workers yara
+    processes themselves, is above THROTTLE_MAX_LOAD.
+    """
+    ADAPT_INTERVAL = 5.0
+    MIN_FACTOR = 0.05
+
+    def __init__(self, config: dict, pool_workers: int = 0):
+        rate = float(config.get('THROTTLE_READ_MBPS', 0)) * 1024 * 1024
+        self.bucket = TokenBucket(rate) if rate > 0 else None
+        self.cpu_ratio = min(1.0, max(0.01, float(config.get('THROTTLE_CPU_PERCENT', 100)) / 100))
+        self.low_priority = bool(config.get('THROTTLE_LOW_PRIORITY'))
+        self.adaptive = bool(config.get('THROTTLE_ADAPTIVE')) and hasattr(os, 'getloadavg')
+        self.max_load = float(config.get('THROTTLE_MAX_LOAD', 0.75))
+        self.workers = int(config.get('PROCESS_WORKERS', 1)) + pool_workers
+        self.factor = 1.0
+        self.__next_adapt = 0.0
+
+    def worker_started(self):
+        """Called from each scan thread"""
+        if self.low_priority:
+            lower_priority()
+
+    def __adapt(self):
+        now = time.monotonic()
+        if not self.adaptive or now < self.__next_adapt:
+            return
+        self.__next_adapt = now + self.ADAPT_INTERVAL
+        try:
+            load = max(0.0, os.getloadavg()[0] - self.workers * self.factor) / (os.cpu_count() or 1)
+        except OSError:
+            return
+        if load > self.max_load:
+            self.factor = max(self.MIN_FACTOR, self.factor / 2)
+        else:
+            self.factor = min(1.0, self.factor * 1.25)
+
+    def read(self, amount: int):
+        """Account for amount bytes read, sleeps if over the rate"""
+        self.__adapt()
+        if self.bucket is not None:
+            self.bucket.consume(amount, self.factor)
+
+    @contextmanager
+    def cpu(self):
+        """Wrap CPU heavy work, sleeps afterwards to honor the duty cycle"""
+        self.__adapt()
+        ratio = self.cpu_ratio * self.factor
+        start = time.perf_counter()
+        yield
+        if ratio < 1.0:
+            busy = time.perf_counter() - start
+            time.sleep(busy * (1.0 - ratio) / ratio)
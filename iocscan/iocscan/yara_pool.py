@@ -0,0 +1,174 @@
+"""
+yara_pool.py : Yara matching in worker processes
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import io
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+
+import yara
+
+from .content_cache import CachedMatch
+from .throttle import lower_priority
+
+STATUS_OK = 0
+STATUS_TIMEOUT = 1
+STATUS_ERROR = 2
+# Extra wait for a batch lost with a crashed worker, a longer match is redone in process
+LOST_BATCH_GRACE = 60
+
+# Rules of the current worker process, loaded once by _init_worker
+_worker_rules = []
+
+
+def pool_size(value) -> int:
+    """Worker count from the YARA_POOL_WORKERS setting, 'auto' for one per core"""
+    if value == 'auto':
+        return os.cpu_count() or 1
+    return max(0, int(value or 0))
+
+
+def _init_worker(sources: list, low_priority: bool):
+    global _worker_rules
+    if low_priority:
+        lower_priority(process=True)
+    _worker_rules = [yara.load(filepath=value) if kind == 'filepath' else yara.load(file=io.BytesIO(value))
+                     for kind, value in sources]
+
+
+def _match_batch(batch: list) -> list:
+    """(status, [(namespace, rule)] or error message, bytes read) for each (rulesets, path, fast, timeout)"""
+    out = []
+    for positions, path, fast, timeout in batch:
+        start = time.monotonic()
+        try:
+            size = os.path.getsize(path)
+            matches = []
+            for pos in positions:
+                kwargs = dict(filepath=path, fast=fast)
+                if timeout:
+                    kwargs['timeout'] = max(1, int(math.ceil(timeout - (time.monotonic() - start))))
+                matches += [(match.namespace, match.rule) for match in _worker_rules[pos].match(**kwargs)]
+            out.append((STATUS_OK, matches, size))
+        except yara.TimeoutError:
+            out.append((STATUS_TIMEOUT, None, 0))
+        except Exception as exc:
+            out.append((STATUS_ERROR, str(exc), 0))
+    return out
+
+
+class _Request(object):
+    __slots__ = ('item', 'done', 'result')
+
+    def __init__(self, item: tuple):
+        self.item = item
+        self.done = threading.Event()
+        self.result = None
+
+
+class YaraPool(object):
+    """Match files by path in a pool of processes with the rules preloaded
+
+    Requests of the scan threads are sent to the workers in batches of up
+    to batch_size, a partial batch waits at most batch_delay seconds.
+    sources holds ('filepath', path) or ('data', compiled rules) per ruleset.
+    With low_priority, the workers lower their CPU and I/O priority.
+    """
+
+    def __init__(self, sources: list, workers: int, batch_size: int = 8, batch_delay: float = 0.005,
+                 low_priority: bool = False):
+        self.batch_size = max(1, batch_size)
+        self.batch_delay = batch_delay
+        self.__pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(sources, low_priority))
+        self.__pending = []
+        self.__cond = threading.Condition()
+        self.__closed = False
+        self.__dispatcher = threading.Thread(target=self.__dispatch, daemon=True)
+        self.__dispatcher.start()
+
+    def __dispatch(self):
+        while True:
+            with self.__cond:
+                while not self.__pending and not self.__closed:
+                    self.__cond.wait()
+                if not self.__pending:
+                    return
+                end = time.monotonic() + self.batch_delay
+                while len(self.__pending) < self.batch_size and not self.__closed:
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.__cond.wait(remaining)
+                batch = self.__pending[:self.batch_size]
+                del self.__pending[:self.batch_size]
+            self.__submit(batch)
+
+    def __submit(self, batch: list):
+        def done(results):
+            for request, result in zip(batch, results):
+                request.result = result
+                request.done.set()
+
+        def failed(exc):
+            done([(STATUS_ERROR, str(exc), 0)] * len(batch))
+
+        try:
+            self.__pool.apply_async(_match_batch, ([request.item for request in batch],),
+                                    callback=done, error_callback=failed)
+        except (ValueError, AssertionError) as exc:
+            # Pool already closed
+            failed(exc)
+
+    def match(self, positions: tuple, path: str, fast: bool, deadline: float = None):
+        """(matches, bytes read) of a file, None if the workers could not read it
+
+        Raises yara.TimeoutError past the deadline.
+        """
+        timeout = max(0.001, deadline - time.monotonic()) if deadline is not None else 0
+        request = _Request((positions, path, fast, timeout))
+        with self.__cond:
+            if self.__closed:
+                return None
+            self.__pending.append(request)
+            self.__cond.notify()
+        # Requests of a batch are matched one after the other, the pool never answers for a crashed worker
+        if not request.done.wait(2 * timeout * self.batch_size + LOST_BATCH_GRACE):
+            logging.warning("No answer from the yara workers for %s", path)
+            return None
+        status, value, size = request.result
+        if status == STATUS_TIMEOUT:
+            raise yara.TimeoutError()
+        if status == STATUS_ERROR:
+            logging.debug("Yara worker failed on %s : %s", path, value)
+            return None
+        return [CachedMatch(namespace, rule) for namespace, rule in value], size
+
+    def close(self):
+        with self.__cond:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__cond.notify_all()
+        self.__dispatcher.join()
+        self.__pool.close()
+        self.__pool.join()
@@ -18,8 +18,10 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
+import hashlib
 import io
 import logging
+import threading
 import time
 import yara
 from typing import Tuple
@@ -27,91 +29,269 @@ from typing import Tuple
 from epc.common.data import DataClient
 from epc.common.data.client import DataException
 from epc.common.exceptions import DataError
+from .detection import Detection, FileInfo
+from .indexer import Indexer, stream_record
+from .metrics import ScanMetrics
+from .path_filter import PathFilter
+from .rule_profiler import RuleProfiler
+from .rule_sets import RuleScope, Ruleset, RulesetGroup, RulesetGroups
+from .rules_cache import RulesCache
+from .stream_pass import StreamPass
+from .yara_pool import YaraPool, pool_size
 
 
 class YaraScanner(object):
-    def __init__(self, config):
+    def __init__(self, config, indexer: Indexer, path_filter: PathFilter, metrics: ScanMetrics = None):
         self.yara_rules = []
+        self.rulesets = None
+        self.ruleset = None
+        self.profiler = None
+        self.pool = None
         self.config = config
+        self.__indexer = indexer
+        self.__path_filter = path_filter
+        self.__metrics = metrics or ScanMetrics()
 
         self.scan_count = 0
+        self.skip_count = 0
         self.detect_count = 0
-        self.report = []
+        self.large_count = 0
+        self.timeout_count = 0
+        self.timed_out = []
+        self.lock = threading.Lock()
 
-    def init(self):
+    def __fetch_rules(self, name: str):
         try:
-            data = DataClient().get('http_blob', self.config.get('RULES_FILE'))
-            if not data:
-                logging.error("Cannot get rules %s", self.config.get('RULES_FILE'))
-                return 1
+            data = DataClient().get('http_blob', name)
         except (DataException, DataError):
-            logging.error('Cannot get rules %s', self.config.get('RULES_FILE'))
-            return 1
-        rules = io.BytesIO(data)
+            data = None
+        if not data:
+            logging.error("Cannot get rules %s", name)
+            return None
+        return data
+
+    def __load_rules(self, name: str, cache: RulesCache = None):
+        """(compiled rules, sha256 of the blob, source for the worker processes) of a rules blob, None on failure"""
+        if cache is not None:
+            cached = cache.get(name, lambda: self.__fetch_rules(name))
+            if cached is None:
+                return None
+            path, digest = cached
+            source = ('filepath', str(path))
+        else:
+            data = self.__fetch_rules(name)
+            if data is None:
+                return None
+            digest = hashlib.sha256(data).digest()
+            source = ('data', data)
 
         try:
-            self.yara_rules.append(yara.load(file=rules))
+            if source[0] == 'filepath':
+                rules = yara.load(filepath=source[1])
+            else:
+                rules = yara.load(file=io.BytesIO(source[1]))
+            return rules, digest, source
         except yara.Error:
-            logging.error("Cannot load rules %s", self.config.get('RULES_FILE'))
+            logging.error("Cannot load rules %s", name)
+            if cache is not None:
+                cache.invalidate(name)
+            return None
+
+    def init(self):
+        cache = None
+        if self.config.get('RULES_CACHE'):
+            cache = RulesCache(ttl=float(self.config.get('RULES_CACHE_TTL', 7 * 24 * 3600)))
+        rulesets = []
+        sources = []
+        # Without RULESETS, RULES_FILE applies to every file
+        for ruleset_config in self.config.get('RULESETS') or [dict(name=self.config.get('RULES_FILE'))]:
+            loaded = self.__load_rules(ruleset_config['name'], cache)
+            if loaded is not None:
+                rulesets.append(Ruleset(ruleset_config['name'], loaded[0], loaded[1],
+                                        RuleScope.from_config(ruleset_config)))
+                sources.append(loaded[2])
+        if not rulesets:
             return 1
+        self.rulesets = RulesetGroups(rulesets)
+        self.yara_rules = [ruleset.rules for ruleset in rulesets]
+        self.ruleset = self.rulesets.fingerprint
+        if self.config.get('YARA_PROFILE'):
+            self.profiler = RuleProfiler(int(self.config.get('YARA_PROFILE_TOP', 20)))
+        workers = pool_size(self.config.get('YARA_POOL_WORKERS'))
+        if workers and self.profiler is None:
+            try:
+                self.pool = YaraPool(sources, workers, batch_size=int(self.config.get('YARA_POOL_BATCH', 8)),
+                                     low_priority=bool(self.config.get('THROTTLE_LOW_PRIORITY')))
+                logging.info("Matching yara rules in %d processes", workers)
+            except (OSError, ImportError, ValueError) as exc:
+                logging.warning("Cannot start the yara processes, matching in process: %s", exc)
+
+        if self.config.get('INCREMENTAL_YARA'):
+            self.__indexer.set_ruleset(self.ruleset)
 
-        logging.info("%d signatures loaded" % len(self.yara_rules))
+        logging.info("%d rulesets loaded: %s", len(self.rulesets), ', '.join(self.rulesets.names))
         self.perf1 = time.perf_counter()
 
-    def __can_scan(self, item):
-        if item.is_directory():
-            return False
-        if not not self.config["INCLUDE_DELETED"] and item.is_deleted():
-            return False
-        if self.config.get('SCAN_EXTENSIONS') and item.path.suffix.lower() not in self.config.get('SCAN_EXTENSIONS'):
-            return False
-        if item.path.name in self.config.get('EXCLUDE_FILES', []):
-            return False
-        return True
-
-    def process(self, mountpoint, fobj):
-        if self.__can_scan(fobj):
+    def process(self, mountpoint, fobj, stream_pass: StreamPass = None) -> list:
+        detections = []
+        if self.__path_filter.can_scan(fobj):
+            if stream_pass is None:
+                stream_pass = StreamPass(fobj, self.config, metrics=self.__metrics)
+            path = self.__path_filter.relative_path(fobj.path)
             for ads, stream in fobj.streams.items():
-                if stream['size'] < self.config.get('MAX_SIZE') * 1024 * 1024:
-                    if not ads or ads == '$Data':
-                        logging.debug("%s%s",
-                                      fobj.path,
-                                      u" (deleted)" if fobj.is_deleted() else u"")
+                large = stream['size'] >= self.config.get('MAX_SIZE') * 1024 * 1024
+                if large and not (self.config.get('YARA_LARGE_FILES') and stream_pass.can_read):
+                    self.__metrics.count('yara_too_large')
+                    continue
+                group = self.rulesets.select(path, fobj.path.suffix, stream['size'])
+                if group is None:
+                    self.__metrics.count('yara_out_of_scope')
+                    continue
+                obj_data = stream_record(mountpoint, fobj, ads, stream)
+                if self.__indexer.get_verdict(obj_data) == []:
+                    # Unchanged file, already found clean with the same ruleset
+                    with self.lock:
+                        self.skip_count += 1
+                    continue
+
+                if not ads or ads == '$Data':
+                    logging.debug("%s%s",
+                                  fobj.path,
+                                  u" (deleted)" if fobj.is_deleted() else u"")
+                else:
+                    logging.debug("%s:%s%s",
+                                  fobj.path,
+                                  ads,
+                                  " (deleted)" if fobj.is_deleted() else u"")
+                timeout = float(self.config.get('YARA_LARGE_TIMEOUT' if large else 'YARA_TIMEOUT') or 0)
+                start = time.perf_counter()
+                deadline = time.monotonic() + timeout if timeout else None
+                try:
+                    if large:
+                        matches, complete = self.__match_windows(group, stream_pass, ads, deadline)
                     else:
-                        logging.debug("%s:%s%s",
-                                      fobj.path,
-                                      ads,
-                                      " (deleted)" if fobj.is_deleted() else u"")
-                    matches = fobj.scan_yara(self.yara_rules, ads,
-                                             self.config.get("YARA_FASTSCAN_MODE", True))
+                        matches, complete = self.__match(group, stream_pass, fobj, ads, deadline), True
+                except yara.TimeoutError:
+                    matches, complete = [], False
+                elapsed = time.perf_counter() - start
+                if self.profiler is not None:
+                    self.profiler.file_time(self.__display_path(fobj, ads), elapsed)
+                with self.lock:
                     self.scan_count += 1
+                    if large:
+                        self.large_count += 1
+                if not complete:
+                    self.__timed_out(fobj, ads, stream['size'], elapsed, large)
+                rules = ['{}:{}'.format(match.namespace, match.rule) for match in matches]
+                if complete:
+                    # A partial scan is not a verdict, the stream is matched again next time
+                    self.__indexer.set_verdict(obj_data, rules)
+                for rule in rules:
+                    self.__metrics.rule_cost(rule, elapsed)
 
-                    if matches:
+                if matches:
+                    hexdigests = stream_pass.get_hexdigests(ads)
+                    info = FileInfo(
+                        filepath=str(fobj.path),
+                        md5=hexdigests.get('md5'),
+                        sha1=hexdigests.get('sha1'),
+                        sha256=hexdigests.get('sha256'),
+                        entropy=hexdigests.get('entropy'),
+                        deleted=fobj.is_deleted()
+                    )
+                    with self.lock:
                         self.detect_count += len(matches)
-                        report_data = dict(
-                            extra=self.config.get("task_id", None),
-                            filepath=str(fobj.path),
-                            md5=fobj.get_hash_md5(ads),
-                            sha1=fobj.get_hash_sha1(ads),
-                            sha256=fobj.get_hash_sha256(ads),
-                            entropy=fobj.get_entropy(ads),
-                            timestamp=self.config.get('timestamp')
-                        )
-                        if fobj.is_deleted():
-                            report_data["deleted"] = True
-                        for match in matches:
-                            report_data['rule'] = '{}:{}'.format(match.namespace, match.rule)
-                            self.report.append(report_data)
+                    detections += [Detection(info, rule) for rule in rules]
+        return detections
+
+    def __timed_out(self, fobj, ads, size: int, elapsed: float, large: bool):
+        self.__metrics.count('yara_timeouts')
+        with self.lock:
+            self.timeout_count += 1
+            if len(self.timed_out) < int(self.config.get('YARA_TIMEOUT_REPORT_MAX', 1000)):
+                self.timed_out.append(dict(path=self.__display_path(fobj, ads), size=size, time=elapsed,
+                                           windowed=large))
+
+    def __match_windows(self, group: RulesetGroup, stream_pass: StreamPass, ads, deadline: float = None):
+        return stream_pass.scan_yara_windows(group.rules, ads, self.config.get("YARA_FASTSCAN_MODE", True),
+                                             window=int(self.config.get('YARA_WINDOW_MB', 16) * 1024 * 1024),
+                                             overlap=int(self.config.get('YARA_WINDOW_OVERLAP_KB', 64) * 1024),
+                                             edge=int(self.config.get('YARA_EDGE_MB', 4) * 1024 * 1024),
+                                             deadline=deadline)
+
+    def __match(self, group: RulesetGroup, stream_pass: StreamPass, fobj, ads, deadline: float = None) -> list:
+        fast = self.config.get("YARA_FASTSCAN_MODE", True)
+        if self.profiler is None:
+            matcher = None
+            if self.pool is not None and (not ads or ads == '$Data') and not fobj.is_deleted():
+                # Only regular files can be opened by path in the workers
+                path = str(fobj.path)
+                matcher = lambda: self.pool.match(group.positions, path, fast, deadline)
+            return stream_pass.scan_yara(group.rules, ads, fast, ruleset=group.fingerprint, deadline=deadline,
+                                         matcher=matcher)
+        # One sub-scan per ruleset to time them separately, buffered streams are still read once
+        matches = []
+        for ruleset in group.rulesets:
+            start = time.perf_counter()
+            try:
+                matches += stream_pass.scan_yara([ruleset.rules], ads, fast, ruleset=ruleset.digest,
+                                                 deadline=deadline)
+            except yara.TimeoutError:
+                self.profiler.timeout(ruleset.name)
+                raise
+            finally:
+                self.profiler.ruleset_time(ruleset.name, time.perf_counter() - start)
+        return matches
+
+    @staticmethod
+    def __display_path(fobj, ads) -> str:
+        if not ads or ads == '$Data':
+            return str(fobj.path)
+        return '{}:{}'.format(fobj.path, ads)
+
+    def save_checkpoint(self) -> dict:
+        with self.lock:
+            return dict(
+                exec_time=time.perf_counter() - self.perf1,
+                scan_count=self.scan_count,
+                skip_count=self.skip_count,
+                detect_count=self.detect_count,
+                large_count=self.large_count,
+                timeout_count=self.timeout_count,
+                timed_out=list(self.timed_out)
+            )
+
+    def restore_checkpoint(self, state: dict):
+        self.perf1 -= state.get('exec_time', 0)
+        self.scan_count = state.get('scan_count', 0)
+        self.skip_count = state.get('skip_count', 0)
+        self.detect_count = state.get('detect_count', 0)
+        self.large_count = state.get('large_count', 0)
+        self.timeout_count = state.get('timeout_count', 0)
+        self.timed_out = state.get('timed_out', [])
+
+    def close(self):
+        """Stop the yara worker processes"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
     def finalize(self) -> Tuple[dict, list]:
+        self.close()
         exec_time = time.perf_counter() - self.perf1
         final_report = dict(
             extra=self.config.get("task_id", None),
-            rules=self.config.get('RULES_FILE'),
+            rules=self.config.get('RULES_FILE') if not self.config.get('RULESETS') else self.rulesets.names,
             exec_time=exec_time,
             scan_count=self.scan_count,
+            skip_count=self.skip_count,
             detect_count=self.detect_count,
+            large_count=self.large_count,
+            timeout_count=self.timeout_count,
+            timed_out_files=self.timed_out,
             timestamp=self.config.get('timestamp')
         )
+        if self.profiler is not None:
+            final_report['profile'] = self.profiler.report(self.yara_rules)
         logging.info("Scan completed %s", final_report)
-        return final_report, self.report
+        return final_report, []